@@ -24,11 +24,14 @@
  ***************************************************************************/
 """
 
+import os
+import bisect
 from sets import Set
 
-from PyQt4.QtCore import QVariant, QDir, QFile
+from PyQt4.QtCore import Qt, QVariant, QDir, QFile, QTimer
+from PyQt4.QtGui import QColor
 
-from qgis.core import QGis, QgsMapLayerRegistry, QgsVectorLayer, QgsProject, QgsSnapper, QgsTolerance, QgsMapLayer, QgsFeatureRequest, QgsRectangle, QgsLayerTreeGroup, NULL, QgsField
+from qgis.core import QGis, QgsMapLayerRegistry, QgsVectorLayer, QgsProject, QgsSnapper, QgsTolerance, QgsMapLayer, QgsFeatureRequest, QgsRectangle, QgsLayerTreeGroup, NULL, QgsField, QgsGeometry
 from qgis.gui import QgsMessageBar, QgsHighlight
 
 import utils, layers, snapping
@@ -43,6 +46,10 @@ class LayerCollectionSettings:
     collectionGroupName = ''
     bufferGroupName = ''
     log = False
+    # OGR driver for the buffer and log layers, 'ESRI Shapefile' or 'GPKG'
+    bufferFormat = 'ESRI Shapefile'
+    # Fields indexed so simple expressions on them are looked up rather than evaluated, e.g. "context" = '123'
+    keyFields = ()
 
     pointsLayerLabel = ''
     pointsLayerName = ''
@@ -81,6 +88,8 @@ class LayerCollectionSettings:
         lcs.parentGroupName = Project.readEntry(scope, path + 'parentGroupName')
         lcs.bufferGroupName = Project.readEntry(scope, path + 'bufferGroupName')
         lcs.log = Project.readBoolEntry(scope, path + 'log')
+        lcs.bufferFormat = Project.readEntry(scope, path + 'bufferFormat', 'ESRI Shapefile')
+        lcs.keyFields = tuple(Project.readListEntry(scope, path + 'keyFields', []))
         lcs.pointsLayerLabel = Project.readEntry(scope, path + 'pointsLayerLabel')
         lcs.pointsLayerName = Project.readEntry(scope, path + 'pointsLayerName')
         lcs.pointsLayerPath = Project.readEntry(scope, path + 'pointsLayerPath')
@@ -112,6 +121,8 @@ class LayerCollectionSettings:
         Project.writeEntry(scope, path + 'parentGroupName', self.parentGroupName)
         Project.writeEntry(scope, path + 'bufferGroupName', self.bufferGroupName)
         Project.writeEntry(scope, path + 'log', self.log)
+        Project.writeEntry(scope, path + 'bufferFormat', self.bufferFormat)
+        Project.writeEntry(scope, path + 'keyFields', list(self.keyFields))
         Project.writeEntry(scope, path + 'pointsLayerLabel', self.pointsLayerLabel)
         Project.writeEntry(scope, path + 'pointsLayerName', self.pointsLayerName)
         Project.writeEntry(scope, path + 'pointsLayerPath', self.pointsLayerPath)
@@ -135,6 +146,239 @@ class LayerCollectionSettings:
         Project.writeEntry(scope, path + 'polygonsLogPath', self.polygonsLogPath)
 
 
+# Tracks the features checked out of a main layer into its buffer, so a merge only has to write the changes.
+# Buffer feature ids change when the buffer is committed, and shapefile main layer ids change when features
+# are deleted from it, so the tracked ids are updated from the commit signals of both. Deleting a checked out
+# feature from the buffer deletes the original on merge, unless the delete is undone.
+class BufferChanges:
+
+    _buffer = None  # QgsVectorLayer()
+    _layer = None  # QgsVectorLayer()
+    _origins = {}  # {bufferFeatureId : layerFeatureId}
+    _changed = set()  # Checked out bufferFeatureIds changed since checkout
+    _added = set()  # bufferFeatureIds not checked out
+    _deleting = {}  # {bufferFeatureId : layerFeatureId} deleted by the current edit or undo
+    _deleted = {}  # {bufferFeatureId : layerFeatureId} deleted since last commit, restored if undone
+    _deletedOrigins = set()  # layerFeatureIds deleted from the committed buffer
+    _originals = {}  # {layerFeatureId : fingerprint} as checked out
+    _lost = 0  # Checkouts whose original has been deleted from the main layer
+    _committed = ({}, set(), set(), set())  # (origins, changed, added, deletedOrigins) as of the last commit
+    _checkout = []  # layerFeatureIds waiting to be added to the buffer
+    _pending = []  # Temporary bufferFeatureIds being committed, in commit order
+    _committing = False
+    _undoIndex = 0
+
+    def __init__(self, buff, layer):
+        self._buffer = buff
+        self._layer = layer
+        self.clear()
+        buff.featureAdded.connect(self._featureAdded)
+        buff.featureDeleted.connect(self._featureDeleted)
+        buff.attributeValueChanged.connect(self._featureChanged)
+        buff.geometryChanged.connect(self._featureChanged)
+        buff.beforeCommitChanges.connect(self._beforeCommit)
+        buff.committedFeaturesAdded.connect(self._committedFeaturesAdded)
+        buff.committedFeaturesRemoved.connect(self._committedFeaturesRemoved)
+        buff.editingStopped.connect(self._editingStopped)
+        buff.undoStack().indexChanged.connect(self._undoIndexChanged)
+        layers.connectCommitted(layer, 'committedFeaturesRemoved', self._layerFeaturesRemoved)
+
+    def clear(self):
+        self._origins = {}
+        self._changed = set()
+        self._added = set()
+        self._deleting = {}
+        self._deleted = {}
+        self._deletedOrigins = set()
+        self._originals = {}
+        self._lost = 0
+        self._committed = ({}, set(), set(), set())
+        self._checkout = []
+        self._pending = []
+        self._committing = False
+        self._undoIndex = self._buffer.undoStack().index()
+
+    def hasCheckouts(self):
+        return len(self._origins) > 0 or len(self.deletedOrigins()) > 0 or self._lost > 0
+
+    # The main layer feature id the buffer feature was checked out from, or None if it is new
+    def origin(self, featureId):
+        return self._origins.get(featureId)
+
+    def isChanged(self, featureId):
+        return featureId in self._changed
+
+    def addedIds(self):
+        return set(self._added)
+
+    def changedIds(self):
+        return set(self._changed)
+
+    # The main layer feature ids of the checked out features deleted from the buffer
+    def deletedOrigins(self):
+        return self._deletedOrigins | set(self._deleted.values())
+
+    # Check the originals of the changed and deleted checkouts are still as they were checked out, the main
+    # layer could have been changed since, e.g. by a feature id being reused
+    def checkOrigins(self):
+        if self._lost > 0:
+            return False
+        featureIds = set([self._origins[featureId] for featureId in self._changed if featureId in self._origins])
+        featureIds |= self.deletedOrigins()
+        if len(featureIds) == 0:
+            return True
+        found = {}
+        request = QgsFeatureRequest().setFilterFids(list(featureIds))
+        with layers.openFeaturesRequest(request, self._layer) as fit:
+            for feature in fit:
+                found[feature.id()] = BufferChanges.fingerprint(feature)
+        for featureId in featureIds:
+            if featureId not in self._originals or found.get(featureId) != self._originals[featureId]:
+                return False
+        return True
+
+    @staticmethod
+    def fingerprint(feature):
+        attributes = tuple([None if value == NULL else value for value in feature.attributes()])
+        geometry = ''
+        if feature.geometry():
+            geometry = feature.geometry().exportToWkt()
+        return (attributes, geometry)
+
+    # The next features added to the buffer are the checked out copies of these layer features, in order
+    def beginCheckout(self, features):
+        self._checkout = [feature.id() for feature in features]
+        for feature in features:
+            self._originals[feature.id()] = BufferChanges.fingerprint(feature)
+
+    def endCheckout(self):
+        self._checkout = []
+
+    def _featureAdded(self, featureId):
+        if featureId in self._origins:
+            return
+        if featureId in self._deleting:
+            self._origins[featureId] = self._deleting.pop(featureId)
+        elif featureId in self._deleted:
+            # Undo of a delete
+            self._origins[featureId] = self._deleted.pop(featureId)
+        elif self._checkout:
+            self._origins[featureId] = self._checkout.pop(0)
+        else:
+            self._added.add(featureId)
+
+    def _featureDeleted(self, featureId):
+        if featureId in self._origins:
+            layerFeatureId = self._origins.pop(featureId)
+            # A failed checkout is undone, so just forget it
+            if not self._checkout:
+                self._deleting[featureId] = layerFeatureId
+        self._changed.discard(featureId)
+        self._added.discard(featureId)
+
+    # Deletes made going forward are the user's, deletes made by an undo are of checkouts being undone
+    def _undoIndexChanged(self, index):
+        if index > self._undoIndex:
+            self._deleted.update(self._deleting)
+        self._deleting = {}
+        self._undoIndex = index
+
+    def _featureChanged(self, featureId, *args):
+        if featureId in self._origins:
+            self._changed.add(featureId)
+
+    def _beforeCommit(self):
+        self._committing = True
+        self._pending = sorted(self._buffer.editBuffer().addedFeatures().keys())
+
+    # The added features are committed in temporary id order, and then have their permanent ids
+    def _committedFeaturesAdded(self, layerId, features):
+        renames = {}
+        for oldId, feature in zip(self._pending, features):
+            renames[oldId] = feature.id()
+        self._rename(renames)
+        self._pending = []
+
+    # Shapefiles are repacked after a delete, which renumbers the remaining features in order
+    def _committedFeaturesRemoved(self, layerId, featureIds):
+        if self._buffer.storageType() != 'ESRI Shapefile':
+            return
+        removed = sorted(featureIds)
+        renames = {}
+        for featureId in set(self._origins.keys()) | self._added:
+            if featureId >= 0:
+                newId = featureId - bisect.bisect_left(removed, featureId)
+                if newId != featureId:
+                    renames[featureId] = newId
+        self._rename(renames)
+
+    def _rename(self, renames):
+        origins = {}
+        for featureId, layerFeatureId in self._origins.items():
+            origins[renames.get(featureId, featureId)] = layerFeatureId
+        self._origins = origins
+        self._changed = set([renames.get(featureId, featureId) for featureId in self._changed])
+        self._added = set([renames.get(featureId, featureId) for featureId in self._added])
+
+    # Features deleted from the main layer, by this collection or through its unfiltered copy
+    def _layerFeaturesRemoved(self, layerId, featureIds):
+        removed = sorted(featureIds)
+        removedIds = set(featureIds)
+        repack = self._layer.storageType() == 'ESRI Shapefile'
+        def remap(layerFeatureId):
+            if layerFeatureId in removedIds:
+                return None
+            if repack:
+                return layerFeatureId - bisect.bisect_left(removed, layerFeatureId)
+            return layerFeatureId
+        origins = {}
+        for featureId, layerFeatureId in self._origins.items():
+            newId = remap(layerFeatureId)
+            if newId is None:
+                self._lost += 1
+            else:
+                origins[featureId] = newId
+        self._origins = origins
+        # The original has already gone, so any delete of it is done
+        for deleted in (self._deleting, self._deleted):
+            for featureId, layerFeatureId in list(deleted.items()):
+                newId = remap(layerFeatureId)
+                if newId is None:
+                    del deleted[featureId]
+                else:
+                    deleted[featureId] = newId
+        self._deletedOrigins = set([remap(featureId) for featureId in self._deletedOrigins]) - set([None])
+        originals = {}
+        for layerFeatureId, fingerprint in self._originals.items():
+            newId = remap(layerFeatureId)
+            if newId is not None:
+                originals[newId] = fingerprint
+        self._originals = originals
+        committedOrigins = {}
+        for featureId, layerFeatureId in self._committed[0].items():
+            newId = remap(layerFeatureId)
+            if newId is not None:
+                committedOrigins[featureId] = newId
+        self._committed = (committedOrigins, self._committed[1], self._committed[2],
+                           set([remap(featureId) for featureId in self._committed[3]]) - set([None]))
+
+    def _editingStopped(self):
+        if self._committing:
+            self._deletedOrigins = self.deletedOrigins()
+            self._committed = (dict(self._origins), set(self._changed), set(self._added), set(self._deletedOrigins))
+        else:
+            # Rolled back to the last commit
+            self._origins = dict(self._committed[0])
+            self._changed = set(self._committed[1])
+            self._added = set(self._committed[2])
+            self._deletedOrigins = set(self._committed[3])
+        self._deleting = {}
+        self._deleted = {}
+        self._pending = []
+        self._committing = False
+        self._undoIndex = self._buffer.undoStack().index()
+
+
 class LayerCollection:
 
     projectPath = ''
@@ -167,13 +411,26 @@ class LayerCollection:
     _collectionGroupIndex = -1
     _bufferGroupIndex = -1
     _highlights = []  # [QgsHighlight]
+    _highlightRequests = []  # [(QgsFeatureRequest, lineColor, fillColor, buff, minWidth)]
+    _highlightConnected = False
+    _filterTimer = None  # QTimer()
+    _changes = {}  # {bufferId : BufferChanges}
+    _liveFilter = None
 
     filter = ''
     selection = ''
     highlight = ''
 
+    # Quiet period in milliseconds before a live filter is applied
+    liveFilterDelay = 300
+    # Maximum number of features highlighted in the canvas view, any more are shown as a single outline
+    highlightLimit = 500
+
     def __init__(self, iface, projectPath, settings):
         self._iface = iface
+        self._changes = {}
+        self._highlights = []
+        self._highlightRequests = []
         self.projectPath = projectPath
         self.settings = settings
         # If the legend indexes change make sure we stay updated
@@ -185,7 +442,10 @@ class LayerCollection:
         return self.loadCollection()
 
     def unload(self):
-        pass
+        self._cancelLiveFilter()
+        if self._highlightConnected:
+            self._iface.mapCanvas().extentsChanged.disconnect(self._refreshHighlights)
+            self._highlightConnected = False
 
     def _groupIndexChanged(self, oldIndex, newIndex):
         if (oldIndex == self._collectionGroupIndex):
@@ -196,6 +456,7 @@ class LayerCollection:
     # If a layer is removed from the registry, (i.e. closed), we can't use it anymore
     def _layersRemoved(self, layerList):
         for layerId in layerList:
+            self._changes.pop(layerId, None)
             if layerId == '':
                 pass
             elif layerId == self.pointsLayerId:
@@ -244,6 +505,19 @@ class LayerCollection:
             layer = None
         return layer, layerId
 
+    # The buffer and log layers use the configured paths, with the extension to match the buffer format
+    def _bufferFilePath(self, layerPath):
+        fullLayerPath = self.projectPath + '/' + layerPath
+        if self.settings.bufferFormat == 'GPKG':
+            layerDir, layerFile = os.path.split(fullLayerPath)
+            return layers.geoPackageFilePath(layerDir, os.path.splitext(layerFile)[0])
+        return fullLayerPath
+
+    def _cloneBufferLayer(self, sourceLayer, fullLayerPath, layerName):
+        if self.settings.bufferFormat == 'GPKG':
+            return layers.cloneAsGeoPackage(sourceLayer, fullLayerPath, layerName)
+        return layers.cloneAsShapefile(sourceLayer, fullLayerPath, layerName)
+
     # Load the buffer layer, create it if it doesn't alreay exist
     def _loadBufferLayer(self, sourceLayer, layerPath, layerName):
         layer = None
@@ -253,11 +527,11 @@ class LayerCollection:
             layer = layerList[0]
             self._iface.legendInterface().moveLayer(layer, self._bufferGroupIndex)
         else:
-            fullLayerPath = self.projectPath + '/' + layerPath
+            fullLayerPath = self._bufferFilePath(layerPath)
             if (layerName and layerPath and sourceLayer and sourceLayer.isValid()):
                 if not QFile.exists(fullLayerPath):
                     # If the layer doesn't exist, clone from the source layer
-                    layer = layers.cloneAsShapefile(sourceLayer, fullLayerPath, layerName)
+                    layer = self._cloneBufferLayer(sourceLayer, fullLayerPath, layerName)
                 else:
                     # If the layer does exist, then load it and copy the style
                     layer = QgsVectorLayer(fullLayerPath, layerName, 'ogr')
@@ -282,11 +556,11 @@ class LayerCollection:
             layer = layerList[0]
             self._iface.legendInterface().moveLayer(layer, self._bufferGroupIndex)
         else:
-            fullLayerPath = self.projectPath + '/' + layerPath
+            fullLayerPath = self._bufferFilePath(layerPath)
             if (layerName and layerPath and sourceLayer and sourceLayer.isValid()):
                 if not QFile.exists(fullLayerPath):
                     # If the layer doesn't exist, clone from the source layer
-                    layer = layers.cloneAsShapefile(sourceLayer, fullLayerPath, layerName)
+                    layer = self._cloneBufferLayer(sourceLayer, fullLayerPath, layerName)
                     if layer and layer.isValid():
                         layer.dataProvider().addAttributes([QgsField('timestamp', QVariant.String, '', 10, 0, 'timestamp')])
                         layer.dataProvider().addAttributes([QgsField('event', QVariant.String, '', 6, 0, 'event')])
@@ -345,24 +619,117 @@ class LayerCollection:
                 and (self.linesLog is None or layers.isWritable(self.linesLog))
                 and (self.polygonsLog is None or layers.isWritable(self.polygonsLog)))
 
-    def mergeBuffers(self, undoMessage='Merge Buffers', log=False, timestamp=None):
+    def mergeBuffers(self, undoMessage='Merge Buffers', log=False, timestamp=None, chunkSize=layers.BULK_CHUNK_SIZE, progress=None, commitChunks=False):
         if timestamp is None and self.settings.log:
             timestamp = utils.timestamp()
+        # Report progress across all three buffers, and stop merging if cancelled
+        state = {'done' : 0, 'cancelled' : False}
+        total = 0
+        for buff in (self.pointsBuffer, self.linesBuffer, self.polygonsBuffer):
+            if buff is not None:
+                total += buff.featureCount()
+        def bufferProgress(done, bufferTotal):
+            if not layers.reportProgress(progress, state['done'] + done, total):
+                state['cancelled'] = True
+                return False
+            return True
         merge = True
-        if layers.copyAllFeatures(self.pointsBuffer, self.pointsLayer, undoMessage + ' - copy points', log, self.pointsLog, timestamp):
-            self._clearBuffer(self.pointsBuffer, undoMessage + ' - delete points')
-        else:
-            merge = False
-        if layers.copyAllFeatures(self.linesBuffer, self.linesLayer, undoMessage + ' - copy lines', log, self.linesLog, timestamp):
-            self._clearBuffer(self.linesBuffer, undoMessage + ' - delete lines')
-        else:
-            merge = False
-        if layers.copyAllFeatures(self.polygonsBuffer, self.polygonsLayer, undoMessage + ' - copy polygons', log, self.polygonsLog, timestamp):
-            self._clearBuffer(self.polygonsBuffer, undoMessage + ' - delete polygons')
-        else:
-            merge = False
+        for buff, layer, logLayer, name in ((self.pointsBuffer, self.pointsLayer, self.pointsLog, 'points'),
+                                            (self.linesBuffer, self.linesLayer, self.linesLog, 'lines'),
+                                            (self.polygonsBuffer, self.polygonsLayer, self.polygonsLog, 'polygons')):
+            ok, count = self._mergeBuffer(buff, layer, logLayer, undoMessage, name, log, timestamp, chunkSize, bufferProgress, commitChunks)
+            state['done'] += count
+            if not ok:
+                merge = False
+            if state['cancelled']:
+                break
         return merge
 
+    def _mergeBuffer(self, buff, layer, logLayer, undoMessage, name, log, timestamp, chunkSize, progress, commitChunks):
+        # Write to the unfiltered copy, or clear the subset, once for the whole merge and only restore the
+        # subset after the commit, otherwise every write would reload the layer and commit through the subset
+        wasEditing = layer.isEditable()
+        target, subset, selection = layers.clearSubset(layer)
+        # Commit the log, layer and buffer together so a failure never leaves a feature in both or neither.
+        # If the user is already editing the layer then it is up to them to commit it.
+        transaction = layers.LayerTransaction([buff])
+        if not wasEditing:
+            transaction = layers.LayerTransaction([logLayer if log else None, target, buff])
+        ok = False
+        count = 0
+        changes = self._changes.get(buff.id())
+        if changes is not None and changes.hasCheckouts():
+            # Only write the new and changed features, checked out features are updated in place
+            ok, count = self._mergeBufferChanges(buff, target, logLayer, changes, transaction, undoMessage, name, log, timestamp, chunkSize, progress)
+        elif not commitChunks:
+            if transaction.begin():
+                ok, count = layers.bulkCopyFeatureRequest(QgsFeatureRequest(), buff, target, undoMessage + ' - copy ' + name, log, logLayer, timestamp, chunkSize, progress)
+                ok = ok and layers.deleteAllFeatures(buff, undoMessage + ' - delete ' + name) and transaction.commit()
+                if not ok:
+                    transaction.rollBack()
+                    count = 0
+        else:
+            # Copy then remove a chunk at a time, so stopping part way only loses the current chunk
+            ok = True
+            while ok:
+                chunk = layers.firstFeatures(QgsFeatureRequest(), buff, chunkSize)
+                if len(chunk) == 0:
+                    break
+                ok = transaction.begin()
+                if ok:
+                    ok = (layers.addFeatures(chunk, target, undoMessage + ' - copy ' + name, log, logLayer, timestamp, chunkSize)
+                          and buff.deleteFeatures([feature.id() for feature in chunk])
+                          and transaction.commit())
+                    if not ok:
+                        transaction.rollBack()
+                if ok:
+                    count += len(chunk)
+                    ok = layers.reportProgress(progress, count, -1)
+        layers.restoreSubset(layer, target, subset, selection, count > 0)
+        # Buffers are always left in edit mode
+        if not buff.isEditable():
+            buff.startEditing()
+        if ok and changes is not None:
+            changes.clear()
+        return ok, count
+
+    def _mergeBufferChanges(self, buff, target, logLayer, changes, transaction, undoMessage, name, log, timestamp, chunkSize, progress):
+        # Don't write over the wrong features if the checked out originals can't be found as they were
+        if not changes.checkOrigins():
+            utils.logWarning('Checked out ' + name + ' have been changed or deleted in the main layer, cannot merge the buffer')
+            return False, 0
+        if not transaction.begin():
+            return False, 0
+        inserts = []
+        updates = {}  # {layerFeatureId : bufferFeature}
+        try:
+            for feature in layers.readFeatures(QgsFeatureRequest(), buff, chunkSize):
+                layerFeatureId = changes.origin(feature.id())
+                if layerFeatureId is None:
+                    inserts.append(feature)
+                elif changes.isChanged(feature.id()):
+                    updates[layerFeatureId] = feature
+        except Exception as error:
+            utils.logWarning('Failed to read the ' + name + ' buffer, cannot merge the buffer: ' + str(error))
+            transaction.rollBack()
+            return False, 0
+        deletes = list(changes.deletedOrigins())
+        ok, count = layers.bulkAddFeatures(inserts, target, undoMessage + ' - copy ' + name, log, logLayer, timestamp, chunkSize, progress)
+        if ok:
+            ok, updated = layers.bulkReplaceFeatures(updates, target, undoMessage + ' - update ' + name, log, logLayer, timestamp)
+            count += updated
+            ok = ok and layers.reportProgress(progress, count, -1)
+        if ok and len(deletes) > 0:
+            request = QgsFeatureRequest().setFilterFids(deletes)
+            ok, deleted = layers.bulkDeleteFeatureRequest(request, target, undoMessage + ' - delete ' + name, log, logLayer, timestamp, chunkSize)
+            count += deleted
+            ok = ok and layers.reportProgress(progress, count, -1)
+        ok = ok and layers.deleteAllFeatures(buff, undoMessage + ' - clear ' + name) and transaction.commit()
+        if not ok:
+            transaction.rollBack()
+            count = 0
+        return ok, count
+
     def resetBuffers(self, undoMessage='Reset Buffers'):
         self._resetBuffer(self.pointsBuffer, undoMessage + ' - points')
         self._resetBuffer(self.linesBuffer, undoMessage + ' - lines')
@@ -377,34 +744,83 @@ class LayerCollection:
         self._clearBuffer(self.polygonsBuffer, undoMessage + ' - polygons')
 
     def _clearBuffer(self, layer, undoMessage):
-        return layers.deleteAllFeatures(layer, undoMessage) and layer.commitChanges() and layer.startEditing()
+        if layers.deleteAllFeatures(layer, undoMessage) and layer.commitChanges() and layer.startEditing():
+            if layer.id() in self._changes:
+                self._changes[layer.id()].clear()
+            return True
+        return False
+
+    def _bufferChanges(self, buff, layer):
+        if buff.id() not in self._changes:
+            self._changes[buff.id()] = BufferChanges(buff, layer)
+        return self._changes[buff.id()]
 
     def moveFeatureRequestToBuffers(self, featureRequest, logMessage='Move Features', log=False, timestamp=None):
-        ret = False
-        if self.pointsBuffer.isEditable():
-            self.pointsBuffer.commitChanges()
-        if self.linesBuffer.isEditable():
-            self.linesBuffer.commitChanges()
-        if self.polygonsBuffer.isEditable():
-            self.polygonsBuffer.commitChanges()
-        if self.copyFeatureRequestToBuffers(featureRequest, logMessage):
-            ret = self.deleteFeatureRequest(featureRequest, logMessage, log, timestamp)
+        if timestamp is None and log:
+            timestamp = utils.timestamp()
+        # Commit the buffers first so they get committed together with the layers
+        for buff in (self.pointsBuffer, self.linesBuffer, self.polygonsBuffer):
+            if buff.isEditable():
+                buff.commitChanges()
+        ret = (layers.moveFeatureRequest(self._request(featureRequest, self.pointsLayer), self.pointsLayer, self.pointsBuffer, logMessage + ' - points', log, self.pointsLog, timestamp)
+               and layers.moveFeatureRequest(self._request(featureRequest, self.linesLayer), self.linesLayer, self.linesBuffer, logMessage + ' - lines', log, self.linesLog, timestamp)
+               and layers.moveFeatureRequest(self._request(featureRequest, self.polygonsLayer), self.polygonsLayer, self.polygonsBuffer, logMessage + ' - polygons', log, self.polygonsLog, timestamp))
         self.pointsBuffer.startEditing()
         self.linesBuffer.startEditing()
         self.polygonsBuffer.startEditing()
         return ret
 
+    # Copy the features to the buffers for editing, leaving the originals in place in the main layers. When the
+    # buffers are merged only the features that have been changed are written back, and are updated in place.
+    def checkoutFeatureRequestToBuffers(self, featureRequest, logMessage='Checkout Features'):
+        ok = True
+        for layer, buff, name in ((self.pointsLayer, self.pointsBuffer, 'points'),
+                                  (self.linesLayer, self.linesBuffer, 'lines'),
+                                  (self.polygonsLayer, self.polygonsBuffer, 'polygons')):
+            with layers.openFeaturesRequest(self._request(featureRequest, layer), layer) as fit:
+                features = list(fit)
+            changes = self._bufferChanges(buff, layer)
+            changes.beginCheckout(features)
+            if not layers.addFeatures(features, buff, logMessage + ' - ' + name):
+                ok = False
+            changes.endCheckout()
+            if not ok:
+                break
+        return ok
+
     def copyFeatureRequestToBuffers(self, featureRequest, logMessage='Copy Features to Buffer'):
-        return (layers.copyFeatureRequest(featureRequest, self.pointsLayer, self.pointsBuffer, logMessage + ' - points')
-                and layers.copyFeatureRequest(featureRequest, self.linesLayer, self.linesBuffer, logMessage + ' - lines')
-                and layers.copyFeatureRequest(featureRequest, self.polygonsLayer, self.polygonsBuffer, logMessage + ' - polygons'))
+        return (layers.copyFeatureRequest(self._request(featureRequest, self.pointsLayer), self.pointsLayer, self.pointsBuffer, logMessage + ' - points')
+                and layers.copyFeatureRequest(self._request(featureRequest, self.linesLayer), self.linesLayer, self.linesBuffer, logMessage + ' - lines')
+                and layers.copyFeatureRequest(self._request(featureRequest, self.polygonsLayer), self.polygonsLayer, self.polygonsBuffer, logMessage + ' - polygons'))
 
-    def deleteFeatureRequest(self, featureRequest, logMessage = 'Delete Features', log=False, timestamp=None):
+    def deleteFeatureRequest(self, featureRequest, logMessage = 'Delete Features', log=False, timestamp=None, chunkSize=layers.BULK_CHUNK_SIZE, progress=None, commitChunks=False):
         if timestamp is None and log:
             timestamp = utils.timestamp()
-        return (layers.deleteFeatureRequest(featureRequest, self.pointsLayer, logMessage + ' - points', log, self.pointsLog, timestamp)
-                and layers.deleteFeatureRequest(featureRequest, self.linesLayer, logMessage + ' - lines', log, self.linesLog, timestamp)
-                and layers.deleteFeatureRequest(featureRequest, self.polygonsLayer, logMessage + ' - polygons', log, self.polygonsLog, timestamp))
+        requests = ((self._request(featureRequest, self.pointsLayer), self.pointsLayer, self.pointsLog, 'points'),
+                    (self._request(featureRequest, self.linesLayer), self.linesLayer, self.linesLog, 'lines'),
+                    (self._request(featureRequest, self.polygonsLayer), self.polygonsLayer, self.polygonsLog, 'polygons'))
+        # Report progress across all three layers, the total is only known if it is known for every layer
+        state = {'done' : 0}
+        total = 0
+        for request, layer, logLayer, name in requests:
+            count = layers.requestCount(request, layer)
+            total = -1 if count < 0 or total < 0 else total + count
+        def layerProgress(done, layerTotal):
+            return layers.reportProgress(progress, state['done'] + done, total)
+        for request, layer, logLayer, name in requests:
+            ok, count = layers.bulkDeleteFeatureRequest(request, layer, logMessage + ' - ' + name, log, logLayer, timestamp, chunkSize, layerProgress, commitChunks)
+            state['done'] += count
+            if not ok:
+                return False
+        return True
+
+    # Resolve requests on the key fields using the field value index, for requests that ignore the layer filter
+    def _request(self, featureRequest, layer):
+        return layers.indexedRequest(featureRequest, layer, self.settings.keyFields, True)
+
+    # As _request() but for requests within the layer filter
+    def _filteredRequest(self, featureRequest, layer):
+        return layers.indexedRequest(featureRequest, layer, self.settings.keyFields)
 
     def setVisible(self, status):
         self.setPointsVisible(status)
@@ -421,20 +837,40 @@ class LayerCollection:
         self._iface.legendInterface().setLayerVisible(self.polygonsLayer, status)
 
     def applyFilter(self, expression):
+        self._cancelLiveFilter()
         self.filter = expression
-        layers.applyFilter(self._iface, self.pointsLayer, expression)
-        layers.applyFilter(self._iface, self.linesLayer, expression)
-        layers.applyFilter(self._iface, self.polygonsLayer, expression)
+        layers.applyFilters(self._iface, [self.pointsLayer, self.linesLayer, self.polygonsLayer], expression)
 
     def clearFilter(self):
         self.applyFilter('')
 
-    def applySelection(self, expression):
+    # Apply a filter that is changing rapidly, e.g. typed in a text box, only the latest expression is applied
+    # once there have been no more changes for liveFilterDelay milliseconds
+    def applyLiveFilter(self, expression):
+        self._liveFilter = expression
+        if self._filterTimer is None:
+            self._filterTimer = QTimer()
+            self._filterTimer.setSingleShot(True)
+            self._filterTimer.timeout.connect(self.flushLiveFilter)
+        # Restarting the timer starts the quiet period again
+        self._filterTimer.start(self.liveFilterDelay)
+
+    # Apply any waiting live filter now, e.g. when return is pressed
+    def flushLiveFilter(self):
+        if self._liveFilter is not None:
+            # Applying stops any render still running for a superseded filter
+            self.applyFilter(self._liveFilter)
+
+    def _cancelLiveFilter(self):
+        self._liveFilter = None
+        if self._filterTimer is not None:
+            self._filterTimer.stop()
+
+    def applySelection(self, expression, rect=None):
         self.selection = expression
         request = QgsFeatureRequest().setFilterExpression(expression)
-        layers.applySelectionRequest(self.pointsLayer, request)
-        layers.applySelectionRequest(self.linesLayer, request)
-        layers.applySelectionRequest(self.polygonsLayer, request)
+        for layer in (self.pointsLayer, self.linesLayer, self.polygonsLayer):
+            layers.applySelectionRequest(layer, self._filteredRequest(request, layer), rect)
 
     def clearSelection(self):
         if self.pointsLayer:
@@ -462,9 +898,8 @@ class LayerCollection:
         return extent
 
     def _extendExtent(self, extent, layer):
-        if (layer is not None and layer.isValid() and layer.featureCount() > 0 and self._iface.legendInterface().isLayerVisible(layer)):
-            layer.updateExtents()
-            layerExtent = layer.extent()
+        if (layer is not None and layer.isValid() and self._iface.legendInterface().isLayerVisible(layer)):
+            layerExtent = layers.layerExtent(layer)
             if layerExtent.isNull() or layerExtent.isEmpty():
                 return extent
             if extent == None:
@@ -483,18 +918,37 @@ class LayerCollection:
         vals.discard('')
         return sorted(vals)
 
+    def uniqueValueCounts(self, fieldName):
+        counts = {}
+        for layer in (self.pointsLayer, self.linesLayer, self.polygonsLayer):
+            for value, count in layers.uniqueValueCounts(layer, fieldName).items():
+                counts[value] = counts.get(value, 0) + count
+        counts.pop('', None)
+        return counts
+
     def updateAttribute(self, attribute, value, expression=None):
-        layers.updateAttribute(self.pointsLayer, attribute, value, expression)
-        layers.updateAttribute(self.linesLayer, attribute, value, expression)
-        layers.updateAttribute(self.polygonsLayer, attribute, value, expression)
+        return self.updateAttributes({attribute : value}, expression)
+
+    def updateAttributes(self, attributeValues, expression=None, undoMessage='Update attributes'):
+        return self._updateAttributes(self.pointsLayer, self.linesLayer, self.polygonsLayer, attributeValues, expression, undoMessage)
 
     def updateBufferAttribute(self, attribute, value, expression=None):
-        layers.updateAttribute(self.pointsBuffer, attribute, value, expression)
-        layers.updateAttribute(self.linesBuffer, attribute, value, expression)
-        layers.updateAttribute(self.polygonsBuffer, attribute, value, expression)
+        return self.updateBufferAttributes({attribute : value}, expression)
+
+    def updateBufferAttributes(self, attributeValues, expression=None, undoMessage='Update attributes'):
+        return self._updateAttributes(self.pointsBuffer, self.linesBuffer, self.polygonsBuffer, attributeValues, expression, undoMessage)
+
+    def _updateAttributes(self, points, lines, polygons, attributeValues, expression, undoMessage):
+        ok = layers.updateAttributes(points, attributeValues, expression, undoMessage + ' - points')
+        ok = layers.updateAttributes(lines, attributeValues, expression, undoMessage + ' - lines') and ok
+        return layers.updateAttributes(polygons, attributeValues, expression, undoMessage + ' - polygons') and ok
 
     def clearHighlight(self):
         self.highlight = ''
+        del self._highlightRequests[:]
+        self._removeHighlights()
+
+    def _removeHighlights(self):
         for hl in self._highlights:
             hl.remove()
         del self._highlights[:]
@@ -503,6 +957,7 @@ class LayerCollection:
         self.clearHighlight()
         self.addHighlight(requestOrExpr, lineColor, fillColor, buff, minWidth)
 
+    # Only the features in the canvas view are highlighted, and they are updated when the view changes
     def addHighlight(self, requestOrExpr, lineColor=None, fillColor=None, buff=None, minWidth=None):
         request = None
         if isinstance(requestOrExpr, QgsFeatureRequest):
@@ -512,12 +967,37 @@ class LayerCollection:
             request = QgsFeatureRequest()
             request.setFilterExpression(requestOrExpr)
             self.highlight = requestOrExpr
-        for feature in self.polygonsLayer.getFeatures(request):
-            hl = layers.addHighlight(self._iface.mapCanvas(), feature, self.polygonsLayer, lineColor, fillColor, buff, minWidth)
-            self._highlights.append(hl)
-        for feature in self.linesLayer.getFeatures(request):
-            hl = layers.addHighlight(self._iface.mapCanvas(), feature, self.linesLayer, lineColor, fillColor, buff, minWidth)
-            self._highlights.append(hl)
-        for feature in self.pointsLayer.getFeatures(request):
-            hl = layers.addHighlight(self._iface.mapCanvas(), feature, self.pointsLayer, lineColor, fillColor, buff, minWidth)
-            self._highlights.append(hl)
+        if not self._highlightConnected:
+            self._iface.mapCanvas().extentsChanged.connect(self._refreshHighlights)
+            self._highlightConnected = True
+        self._highlightRequests.append((request, lineColor, fillColor, buff, minWidth))
+        self._refreshHighlights()
+
+    def _refreshHighlights(self):
+        self._removeHighlights()
+        if not self._highlightRequests:
+            return
+        canvas = self._iface.mapCanvas()
+        mapSettings = canvas.mapSettings()
+        count = 0
+        for request, lineColor, fillColor, buff, minWidth in self._highlightRequests:
+            # Outline of the features over the limit
+            summary = None
+            for layer in (self.polygonsLayer, self.linesLayer, self.pointsLayer):
+                if layer is None:
+                    continue
+                rect = mapSettings.mapToLayerCoordinates(layer, canvas.extent())
+                for feature in layers.getFeaturesInRect(self._filteredRequest(request, layer), layer, rect):
+                    if count < self.highlightLimit:
+                        hl = layers.addHighlight(canvas, feature, layer, lineColor, fillColor, buff, minWidth)
+                        self._highlights.append(hl)
+                        count += 1
+                    elif feature.geometry():
+                        bounds = mapSettings.layerToMapCoordinates(layer, feature.geometry().boundingBox())
+                        if summary is None:
+                            summary = QgsRectangle(bounds)
+                        else:
+                            summary.combineExtentWith(bounds)
+            if summary is not None:
+                hl = layers.addHighlight(canvas, QgsGeometry.fromRect(summary), None, lineColor, QColor(Qt.transparent))
+                self._highlights.append(hl)
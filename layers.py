@@ -24,19 +24,159 @@
  ***************************************************************************/
 """
 
-from PyQt4.QtCore import pyqtSignal, QFileInfo, QFile, QSettings
-from PyQt4.QtGui import QDialog, QComboBox, QDialogButtonBox, QColor
+import os
+import re
+import bisect
+import sqlite3
+import time
+from contextlib import contextmanager
+from Queue import Queue, Empty, Full
+
+from PyQt4.QtCore import Qt, pyqtSignal, QVariant, QThread, QAbstractListModel, QModelIndex, QDir, QFileInfo, QFile, QFileSystemWatcher, QSettings
+from PyQt4.QtGui import QDialog, QComboBox, QDialogButtonBox, QColor, QSortFilterProxyModel
 from PyQt4.QtXml import QDomImplementation, QDomDocument
 
-from qgis.core import QGis, QgsMapLayer, QgsMapLayerRegistry, QgsVectorLayer, QgsVectorFileWriter, QgsProject, QgsLayerTreeGroup, NULL, QgsFeature, QgsFeatureRequest
+from qgis.core import QGis, QgsMapLayer, QgsMapLayerRegistry, QgsVectorLayer, QgsDataSourceURI, QgsVectorFileWriter, QgsProject, QgsLayerTreeGroup, NULL, QgsField, QgsFeature, QgsFeatureRequest, QgsVectorLayerFeatureSource, QgsRectangle, QgsGeometry
 from qgis.gui import QgsHighlight
 
+try:
+    from qgis.core import QgsTransaction
+except ImportError:
+    QgsTransaction = None
+
 import utils
 from project import Project
 from canvas_items import GeometryHighlight, FeatureHighlight
 
 # Layer Widgets
 
+# List of all the layers in the registry, updated as layers are added and removed, with their position in the
+# legend. Use layerListModel() to get the shared instance rather than creating a new one.
+class LayerListModel(QAbstractListModel):
+
+    legendChanged = pyqtSignal()
+
+    _layers = []  # [QgsMapLayer]
+    _legend = {}  # {layerId : position}
+
+    def __init__(self, parent=None):
+        super(LayerListModel, self).__init__(parent)
+        self._layers = []
+        self._legend = {}
+        registry = QgsMapLayerRegistry.instance()
+        registry.layersAdded.connect(self._layersAdded)
+        registry.layersWillBeRemoved.connect(self._layersWillBeRemoved)
+        self._layersAdded(registry.mapLayers().values())
+        root = QgsProject.instance().layerTreeRoot()
+        root.addedChildren.connect(self._legendChanged)
+        root.removedChildren.connect(self._legendChanged)
+        self._legendChanged()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._layers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() < 0 or index.row() >= len(self._layers):
+            return None
+        if role == Qt.DisplayRole:
+            return self._layers[index.row()].name()
+        if role == Qt.UserRole:
+            return self._layers[index.row()].id()
+        return None
+
+    def layer(self, row):
+        if row < 0 or row >= len(self._layers):
+            return None
+        return self._layers[row]
+
+    # Position of the layer in the legend, or -1 if the layer isn't in the legend
+    def legendPosition(self, row):
+        layer = self.layer(row)
+        if layer is None:
+            return -1
+        return self._legend.get(layer.id(), -1)
+
+    def _legendChanged(self, *args):
+        self._legend = {}
+        for node in QgsProject.instance().layerTreeRoot().findLayers():
+            self._legend[node.layerId()] = len(self._legend)
+        self.legendChanged.emit()
+
+    def _row(self, layerId):
+        for row in range(len(self._layers)):
+            if self._layers[row].id() == layerId:
+                return row
+        return -1
+
+    def _layersAdded(self, layerList):
+        layerList = [layer for layer in layerList if self._row(layer.id()) < 0]
+        if len(layerList) == 0:
+            return
+        first = len(self._layers)
+        self.beginInsertRows(QModelIndex(), first, first + len(layerList) - 1)
+        self._layers.extend(layerList)
+        self.endInsertRows()
+        for layer in layerList:
+            layer.layerNameChanged.connect(self._layerNameChanged)
+
+    def _layersWillBeRemoved(self, layerIds):
+        for layerId in layerIds:
+            row = self._row(layerId)
+            if row >= 0:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self._layers[row]
+                self.endRemoveRows()
+
+    def _layerNameChanged(self):
+        row = self._row(self.sender().id())
+        if row >= 0:
+            index = self.index(row, 0)
+            self.dataChanged.emit(index, index)
+
+
+_layerListModel = None  # LayerListModel()
+
+def layerListModel():
+    global _layerListModel
+    if _layerListModel is None:
+        _layerListModel = LayerListModel()
+    return _layerListModel
+
+
+# Filter of the shared layer list for a layer type and/or geometry type, showing only the legend layers in
+# legend order
+class LayerFilterModel(QSortFilterProxyModel):
+
+    _layerType = None
+    _geometryType = None
+
+    def __init__(self, layerType=None, geometryType=None, parent=None):
+        super(LayerFilterModel, self).__init__(parent)
+        self._layerType = layerType
+        self._geometryType = geometryType
+        self.setSourceModel(layerListModel())
+        self.sourceModel().legendChanged.connect(self.invalidate)
+        self.setDynamicSortFilter(True)
+        self.sort(0)
+
+    def lessThan(self, left, right):
+        return self.sourceModel().legendPosition(left.row()) < self.sourceModel().legendPosition(right.row())
+
+    def filterAcceptsRow(self, sourceRow, sourceParent):
+        layer = self.sourceModel().layer(sourceRow)
+        if layer is None or self.sourceModel().legendPosition(sourceRow) < 0:
+            return False
+        if self._layerType is None and self._geometryType is None:
+            return True
+        elif (self._layerType == QgsMapLayer.RasterLayer and layer.type() == QgsMapLayer.RasterLayer):
+            return True
+        elif layer.type() == QgsMapLayer.VectorLayer:
+            return (self._geometryType == None or layer.geometryType() == self._geometryType)
+        return False
+
+
 class ArkLayerComboBox(QComboBox):
 
     layerChanged = pyqtSignal()
@@ -50,21 +190,7 @@ class ArkLayerComboBox(QComboBox):
         self._iface = iface
         self._layerType = layerType
         self._geometryType = geometryType
-        self._loadLayers()
-
-    def _addLayer(self, layer):
-        self.addItem(layer.name(), layer.id())
-
-    def _loadLayers(self):
-        self.clear()
-        for layer in self._iface.legendInterface().layers():
-            if self._layerType is None and self._geometryType is None:
-                self._addLayer(layer)
-            elif (self._layerType == QgsMapLayer.RasterLayer and layer.type() == QgsMapLayer.RasterLayer):
-                self._addLayer(layer)
-            elif layer.type() == QgsMapLayer.VectorLayer:
-                if (self._geometryType == None or layer.geometryType() == self._geometryType):
-                    self._addLayer(layer)
+        self.setModel(LayerFilterModel(layerType, geometryType, self))
 
 
 class ArkSelectLayerDialog(QDialog):
@@ -112,25 +238,50 @@ class ArkSelectLayerDialog(QDialog):
 
 # Layer management utilities
 
+# Default number of features pushed to the edit buffer or provider in a single call
+BULK_CHUNK_SIZE = 1000
+
+# Index of the style files in each style directory, so finding a style doesn't need a file probe per
+# candidate. A directory is rescanned if its modified time has changed, which is only checked at most
+# every STYLE_CACHE_SECONDS.
+
+STYLE_CACHE_SECONDS = 10
+_styleDirs = {}  # {path : (lastModified, set(fileName), checkedTime)}
+
+def _styleFiles(path):
+    now = time.time()
+    entry = _styleDirs.get(path)
+    if entry is not None and now - entry[2] < STYLE_CACHE_SECONDS:
+        return entry[1]
+    lastModified = QFileInfo(path).lastModified()
+    if entry is not None and entry[0] == lastModified:
+        files = entry[1]
+    else:
+        files = set([os.path.normcase(fileName) for fileName in QDir(path).entryList(['*.qml'], QDir.Files)])
+    _styleDirs[path] = (lastModified, files, now)
+    return files
+
+def _findStyle(path, name):
+    if not path or not name:
+        return ''
+    filePath = path + '/' + name + '.qml'
+    # Only the directory itself is indexed
+    if '/' in name or '\\' in name:
+        return filePath if QFile.exists(filePath) else ''
+    if os.path.normcase(name + '.qml') in _styleFiles(path):
+        return filePath
+    return ''
+
+def clearStyleCache():
+    _styleDirs.clear()
+
 # Try find a style file to match a layer
 def styleFilePath(layerPath, layerName, customStylePath, customStyleName, defaultStylePath, defaultStyleName):
-    # First see if the layer itself has a default style saved
-    if layerPath and layerName:
-        filePath = layerPath + '/' + layerName + '.qml'
-        if QFile.exists(filePath):
-            return filePath
-    # Next see if the default name has a style in the style folder
-    if customStylePath and customStyleName:
-        filePath = customStylePath + '/' + customStyleName + '.qml'
-        if QFile.exists(filePath):
-            return filePath
-    # Finally, check the plugin folder for the default style
-    if defaultStylePath and defaultStyleName:
-        filePath = defaultStylePath + '/' + defaultStyleName + '.qml'
-        if QFile.exists(filePath):
-            return filePath
-    # If we didn't anythign then don't use a style
-    return ''
+    # First see if the layer itself has a default style saved, next see if the default name has a style in
+    # the style folder, finally check the plugin folder for the default style, otherwise don't use a style
+    return (_findStyle(layerPath, layerName)
+            or _findStyle(customStylePath, customStyleName)
+            or _findStyle(defaultStylePath, defaultStyleName))
 
 def shapeFilePath(layerPath, layerName):
     return layerPath + '/' + layerName + '.shp'
@@ -143,14 +294,39 @@ def createShapefile(filePath, name, wkbType, crs, fields, styleURI=None, symbolo
     loadStyle(layer, styleURI, symbology)
     return layer
 
-def createMemoryLayer(name, wkbType, crs, fields=None, styleURI=None, symbology=None):
-    uri = wkbToMemoryType(wkbType) + "?crs=" + crs.authid() + "&index=yes"
+def geoPackageFilePath(layerPath, layerName):
+    return layerPath + '/' + layerName + '.gpkg'
+
+def createGeoPackage(filePath, name, wkbType, crs, fields, styleURI=None, symbology=None):
+    # WARNING This will overwrite existing files
+    writer = QgsVectorFileWriter(filePath, 'UTF-8', fields, wkbType, crs, 'GPKG', [], ['SPATIAL_INDEX=YES'])
+    del writer
+    # WAL journaling is persistent in the file, and lets commits append rather than rewrite the journal
+    _setJournalMode(filePath, 'WAL')
+    layer = QgsVectorLayer(filePath, name, 'ogr')
+    loadStyle(layer, styleURI, symbology)
+    return layer
+
+def _setJournalMode(filePath, mode):
+    try:
+        db = sqlite3.connect(filePath)
+        db.execute('PRAGMA journal_mode=' + mode)
+        db.close()
+    except sqlite3.Error:
+        utils.logWarning('Unable to set journal mode on ' + filePath)
+
+def createMemoryLayer(name, wkbType, crs, fields=None, styleURI=None, symbology=None, index=True):
+    uri = wkbToMemoryType(wkbType) + "?crs=" + crs.authid()
+    if index:
+        uri += "&index=yes"
     layer = QgsVectorLayer(uri, name, 'memory')
     if (layer and layer.isValid()):
         if fields:
             layer.dataProvider().addAttributes(fields.toList())
         else:
             layer.dataProvider().addAttributes([QgsField('id', QVariant.String, '', 10, 0, 'ID')])
+        # Make the layer pick up the new provider fields
+        layer.updateFields()
         loadStyle(layer, styleURI, symbology)
     return layer
 
@@ -174,27 +350,42 @@ def cloneAsShapefile(layer, filePath, name, styleURI=None, symbology=None):
         return createShapefile(filePath, name, layer.wkbType(), layer.crs(), layer.dataProvider().fields(), styleURI, symbology)
     return QgsVectorLayer()
 
+def cloneAsGeoPackage(layer, filePath, name, styleURI=None, symbology=None):
+    # WARNING This will overwrite existing files
+    if (layer is not None and layer.isValid() and layer.type() == QgsMapLayer.VectorLayer):
+        if styleURI is None and symbology is None:
+            symbology = getSymbology(layer)
+        return createGeoPackage(filePath, name, layer.wkbType(), layer.crs(), layer.dataProvider().fields(), styleURI, symbology)
+    return QgsVectorLayer()
+
 def duplicateAsShapefile(layer, filePath, name, selected=False):
     shp = cloneAsShapefile(layer, filePath, name)
     return copyFeatures(layer, shp, selected)
 
-def cloneAsMemoryLayer(layer, name, styleURI=None, symbology=None):
+def cloneAsMemoryLayer(layer, name, styleURI=None, symbology=None, index=True):
     if (layer is not None and layer.isValid() and layer.type() == QgsMapLayer.VectorLayer):
         if styleURI is None and symbology is None:
             symbology = getSymbology(layer)
-        mem = createMemoryLayer(name, layer.wkbType(), layer.crs(), layer.dataProvider().fields(), styleURI, symbology)
-        # Hack required to keep fields defined!
-        mem.startEditing()
-        ft = QgsFeature(layer.dataProvider().fields())
-        mem.addFeature(ft)
-        mem.deleteFeature(ft.id())
-        mem.commitChanges()
-        return mem
+        return createMemoryLayer(name, layer.wkbType(), layer.crs(), layer.dataProvider().fields(), styleURI, symbology, index)
     return QgsVectorLayer()
 
-def duplicateAsMemoryLayer(layer, name, selected=False):
-    mem = cloneAsMemoryLayer(layer, name)
-    return copyFeatures(layer, mem, selected)
+# Copy the features straight into the memory provider in chunks, without going through an edit buffer.
+# The spatial index is built once all the features are loaded rather than updated for every feature.
+def duplicateAsMemoryLayer(layer, name, selected=False, index=True, chunkSize=BULK_CHUNK_SIZE):
+    mem = cloneAsMemoryLayer(layer, name, index=False)
+    if mem.isValid():
+        fi = None
+        if selected:
+            fi = layer.selectedFeaturesIterator()
+        else:
+            fi = layer.getFeatures()
+        provider = mem.dataProvider()
+        for chunk in _chunks(fi, chunkSize):
+            provider.addFeatures(chunk)
+        if index:
+            provider.createSpatialIndex()
+        mem.updateExtents()
+    return mem
 
 def loadStyle(layer, styleURI=None, symbology=None, fromLayer=None):
     if (layer is not None and layer.isValid() and layer.type() == QgsMapLayer.VectorLayer):
@@ -205,7 +396,29 @@ def loadStyle(layer, styleURI=None, symbology=None, fromLayer=None):
         elif fromLayer and fromLayer.isValid() and fromLayer.type() == QgsMapLayer.VectorLayer:
             copySymbology(fromLayer, layer)
 
+# Serialised symbology of each source layer, cleared when the layer style changes
+_symbologyCache = {}  # {layerId : QDomElement}
+_symbologyConnected = set()
+
+def _clearSymbology(layerId):
+    _symbologyCache.pop(layerId, None)
+
 def getSymbology(source):
+    layerId = source.id()
+    rootNode = _symbologyCache.get(layerId)
+    if rootNode is None:
+        rootNode = _writeSymbology(source)
+        _symbologyCache[layerId] = rootNode
+        if layerId not in _symbologyConnected:
+            _connectRegistry()
+            _symbologyConnected.add(layerId)
+            source.rendererChanged.connect(lambda: _clearSymbology(layerId))
+            # Only available in later versions of QGIS 2
+            if hasattr(source, 'styleChanged'):
+                source.styleChanged.connect(lambda: _clearSymbology(layerId))
+    return rootNode
+
+def _writeSymbology(source):
     di = QDomImplementation()
     documentType = di.createDocumentType('qgis', 'http://mrcc.com/qgis.dtd', 'SYSTEM')
     doc = QDomDocument(documentType)
@@ -218,24 +431,73 @@ def getSymbology(source):
 def copySymbology(source, dest):
     dest.readSymbology(getSymbology(source), '')
 
+# Cache of legend group name to index, rebuilt after any change to the layer tree
+_groupIndexes = None  # {groupName : groupIndex}
+_groupTreeConnected = False
+_groupIndexesSuspended = False
+
+def _invalidateGroupIndexes(*args):
+    global _groupIndexes
+    if not _groupIndexesSuspended:
+        _groupIndexes = None
+
+def _groupIndexCache(iface):
+    global _groupIndexes, _groupTreeConnected
+    if not _groupTreeConnected:
+        # Signals from all the child nodes are passed up to the root
+        root = QgsProject.instance().layerTreeRoot()
+        root.addedChildren.connect(_invalidateGroupIndexes)
+        root.removedChildren.connect(_invalidateGroupIndexes)
+        # Only available in later versions of QGIS 2
+        if hasattr(root, 'nameChanged'):
+            root.nameChanged.connect(_invalidateGroupIndexes)
+        iface.legendInterface().groupIndexChanged.connect(_invalidateGroupIndexes)
+        _groupTreeConnected = True
+    if _groupIndexes is None:
+        _groupIndexes = {}
+        i = 0
+        for name in iface.legendInterface().groups():
+            if name not in _groupIndexes:
+                _groupIndexes[name] = i
+            i += 1
+    return _groupIndexes
+
 def getGroupIndex(iface, groupName):
-    groupIndex = -1
-    i = 0
-    for name in iface.legendInterface().groups():
-        if (groupIndex < 0 and name == groupName):
-            groupIndex = i
-        i += 1
-    return groupIndex
+    return _groupIndexCache(iface).get(groupName, -1)
 
 def createLayerGroup(iface, groupName, parentGroupName=''):
-    groupIndex = getGroupIndex(iface, groupName)
-    if (groupIndex >= 0):
-        return groupIndex
-    if parentGroupName:
-        parentGroupIndex = getGroupIndex(iface, parentGroupName)
-        if (parentGroupIndex >= 0):
-            return iface.legendInterface().addGroup(groupName, True, parentGroupIndex)
-    return iface.legendInterface().addGroup(groupName, True)
+    return createLayerGroups(iface, [(groupName, parentGroupName)])[groupName]
+
+# Create a hierarchy of groups in one pass, groups is a list of (groupName, parentGroupName) with each parent
+# listed before its children, returns {groupName : groupIndex} for all the groups
+def createLayerGroups(iface, groups):
+    global _groupIndexesSuspended
+    indexes = _groupIndexCache(iface)
+    result = {}
+    # Keep the cache updated ourselves rather than rebuilding it after every new group
+    _groupIndexesSuspended = True
+    try:
+        for groupName, parentGroupName in groups:
+            groupIndex = indexes.get(groupName, -1)
+            if groupIndex < 0:
+                parentGroupIndex = -1
+                if parentGroupName:
+                    parentGroupIndex = indexes.get(parentGroupName, -1)
+                if (parentGroupIndex >= 0):
+                    groupIndex = iface.legendInterface().addGroup(groupName, True, parentGroupIndex)
+                else:
+                    groupIndex = iface.legendInterface().addGroup(groupName, True)
+                # Every group from the new index onwards has moved down one
+                for name in indexes:
+                    if indexes[name] >= groupIndex:
+                        indexes[name] += 1
+                indexes[groupName] = groupIndex
+                for name in result:
+                    result[name] = indexes[name]
+            result[groupName] = groupIndex
+    finally:
+        _groupIndexesSuspended = False
+    return result
 
 def getLayerId(layerName):
     layerList = QgsMapLayerRegistry.instance().mapLayersByName(layerName)
@@ -280,231 +542,746 @@ def wkbToMemoryType(wkbType):
         return 'multipolygon'
     return 'unknown'
 
-def getAllFeaturesRequest(featureRequest, layer):
-    # Stash the current selection
+# Layer caches, all dropped when the layer is removed from the registry
+
+_registryConnected = False
+
+def _connectRegistry():
+    global _registryConnected
+    if not _registryConnected:
+        QgsMapLayerRegistry.instance().layersWillBeRemoved.connect(_layersWillBeRemoved)
+        _registryConnected = True
+
+def _layersWillBeRemoved(layerIds):
+    for layerId in layerIds:
+        _unfilteredLayers.pop(layerId, None)
+        _staleUnfilteredLayers.discard(layerId)
+        _commitListeners.pop(layerId, None)
+        _featureIdCache.pop(layerId, None)
+        for key in [key for key in _valueIndexes if key[0] == layerId]:
+            del _valueIndexes[key]
+        _clearWritableCache(layerId)
+        _symbologyCache.pop(layerId, None)
+        _symbologyConnected.discard(layerId)
+        _extentCache.pop(layerId, None)
+        _extentConnected.discard(layerId)
+
+# Clear any cached query results for the layer, call if the layer data has been changed from outside QGIS
+def clearLayerCaches(layer):
+    if layer is None:
+        return
+    _clearCaches(layer)
+    if layer.id() in _unfilteredLayers:
+        _staleUnfilteredLayers.add(layer.id())
+    for key, index in _valueIndexes.items():
+        if key[0] == layer.id():
+            index.invalidate()
+
+# Clear the layer caches that aren't kept up to date from the layer commit signals
+def _clearCaches(layer):
+    _clearWritableCache(layer.id())
+    _clearSymbology(layer.id())
+    _clearExtent(layer.id())
+    if layer.id() in _featureIdCache:
+        _featureIdCache[layer.id()].clear()
+
+# Unfiltered copies of layers that have a subset string, so features can be read and written without
+# clearing and restoring the subset which forces a provider reload, extent update and repaint each time
+
+_unfilteredLayers = {}  # {layerId : QgsVectorLayer}
+_staleUnfilteredLayers = set()
+
+# Source of the layer without the subset, or None if the provider isn't known to open the same data from it
+def _unfilteredSource(layer):
+    if layer.providerType() == 'postgres' or layer.providerType() == 'spatialite':
+        uri = QgsDataSourceURI(layer.source())
+        uri.setSql('')
+        return uri.uri()
+    if layer.providerType() == 'ogr':
+        return '|'.join([part for part in layer.source().split('|') if not part.startswith('subset=')])
+    return None
+
+# Get a cached copy of the layer with no subset, not added to the registry, or None if it can't be opened
+# without a subset from the same source. The copy is reloaded if the layer has been edited since it was
+# last used, or its caches cleared.
+def unfilteredLayer(layer):
+    if isInvalid(layer):
+        return None
+    if not layer.subsetString():
+        return layer
+    _connectRegistry()
+    layerId = layer.id()
+    unfiltered = _unfilteredLayers.get(layerId)
+    if unfiltered is None:
+        source = _unfilteredSource(layer)
+        if source is None:
+            return None
+        unfiltered = QgsVectorLayer(source, layer.name(), layer.providerType())
+        if not unfiltered.isValid() or unfiltered.subsetString():
+            return None
+        _unfilteredLayers[layerId] = unfiltered
+        layer.editingStopped.connect(lambda: _staleUnfilteredLayers.add(layerId))
+        # Commits through the copy change the layer features, so pass them on to the layer commit listeners
+        unfiltered.committedFeaturesAdded.connect(lambda copyId, features: _copyCommitted(layerId, 'committedFeaturesAdded', features))
+        unfiltered.committedFeaturesRemoved.connect(lambda copyId, featureIds: _copyCommitted(layerId, 'committedFeaturesRemoved', featureIds))
+        unfiltered.committedAttributeValuesChanges.connect(lambda copyId, changes: _copyCommitted(layerId, 'committedAttributeValuesChanges', changes))
+    elif layerId in _staleUnfilteredLayers:
+        unfiltered.reload()
+    _staleUnfilteredLayers.discard(layerId)
+    return unfiltered
+
+# Listeners to a layer commit signal that are also called for commits made through the unfiltered copy
+
+_commitListeners = {}  # {layerId : [(signal, slot)]}
+
+# Connect the slot to the named commit signal of the layer, i.e. 'committedFeaturesAdded',
+# 'committedFeaturesRemoved' or 'committedAttributeValuesChanges', and to the same signal of its unfiltered copy
+def connectCommitted(layer, signal, slot):
+    _connectRegistry()
+    getattr(layer, signal).connect(slot)
+    _commitListeners.setdefault(layer.id(), []).append((signal, slot))
+
+def _copyCommitted(layerId, signal, changes):
+    for listenerSignal, slot in list(_commitListeners.get(layerId, [])):
+        if listenerSignal == signal:
+            slot(layerId, changes)
+
+# Get the layer to work on ignoring any subset, returns (target, subset, selection) to pass to restoreSubset().
+# If the layer is being edited then the changes must go through its edit buffer, so the subset has to be
+# cleared, otherwise the unfiltered copy is used and the layer is left untouched.
+def clearSubset(layer):
+    subset = layer.subsetString()
+    if not subset:
+        return layer, '', []
+    if not layer.isEditable():
+        unfiltered = unfilteredLayer(layer)
+        if unfiltered is not None:
+            return unfiltered, '', []
+    # Stash the current selection and subset
     selection = []
     if layer.selectedFeatureCount() > 0:
         selection = layer.selectedFeaturesIds()
-    # Stash the current subset
-    subset = layer.subsetString()
-    # Clear the current subset
+    layer.setSubsetString('')
+    return layer, subset, selection
+
+def restoreSubset(layer, target, subset, selection, changed=False):
     if subset:
-        layer.setSubsetString('')
-    # Get all the features
+        # Restore the previous subset and selection
+        layer.setSubsetString(subset)
+        if len(selection) > 0:
+            layer.select(selection)
+    elif target is not layer and changed:
+        # Changed through the unfiltered copy, so the layer needs to reload to see the changes, the copy made
+        # the changes so is already up to date and the commit listeners have been told about them
+        layer.reload()
+        _clearCaches(layer)
+        layer.triggerRepaint()
+
+# Copy a request adding hints to only fetch the named attributes and/or no geometry, any attributes or
+# geometry needed by the filter expression will still be fetched
+def hintRequest(featureRequest, layer, attributes=None, noGeometry=False):
+    request = QgsFeatureRequest(featureRequest)
+    if attributes is None and not noGeometry:
+        return request
+    needsGeometry = (request.filterType() == QgsFeatureRequest.FilterRect
+                     and request.flags() & QgsFeatureRequest.ExactIntersect)
+    expression = request.filterExpression()
+    if request.filterType() == QgsFeatureRequest.FilterExpression and expression is not None:
+        if attributes is not None:
+            attributes = list(attributes) + [name for name in expression.referencedColumns() if name not in attributes]
+        needsGeometry = expression.needsGeometry()
+    flags = request.flags()
+    if needsGeometry:
+        flags = flags & ~QgsFeatureRequest.NoGeometry
+    elif noGeometry:
+        flags = flags | QgsFeatureRequest.NoGeometry
+    request.setFlags(flags)
+    if attributes is not None:
+        request.setSubsetOfAttributes(attributes, layer.fields())
+    return request
+
+def getAllFeaturesRequest(featureRequest, layer):
+    with openFeaturesRequest(featureRequest, layer) as features:
+        return list(features)
+
+# Context manager yielding a lazy iterator over all the features for a request ignoring any subset, if the
+# subset had to be cleared then it and the selection are restored on exit. Use attributes and noGeometry to hint what to fetch.
+#     with layers.openFeaturesRequest(request, layer, ['context'], True) as features:
+#         for feature in features:
+@contextmanager
+def openFeaturesRequest(featureRequest, layer, attributes=None, noGeometry=False):
+    source, subset, selection = clearSubset(layer)
+    fit = source.getFeatures(hintRequest(featureRequest, source, attributes, noGeometry))
+    try:
+        yield fit
+    finally:
+        fit.close()
+        restoreSubset(layer, source, subset, selection)
+
+# The bulk write functions take an optional progress(done, total) callback that is called after each
+# chunk is written, total is -1 if not known in advance. Return False from the callback to cancel, any
+# uncommitted changes are then rolled back. If commitChunks is True and the layer wasn't already being
+# edited then each chunk is committed as it is written, so a cancel or failure only loses the last chunk.
+
+def _chunks(iterable, chunkSize):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= chunkSize:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+# Reads the features for a request in a background thread. The reader works on a snapshot of the layer taken
+# when it is created, which has its own provider connection and includes any uncommitted edits. Call start()
+# and then nextChunk() until it returns None, or use readFeatures() to iterate them on the main thread.
+class FeatureReader(QThread):
+
+    _source = None  # QgsVectorLayerFeatureSource
+    _request = None  # QgsFeatureRequest
+    _chunkSize = BULK_CHUNK_SIZE
+    _cancelled = False
+    _queue = None  # Queue
+    _error = None  # Exception raised by the read
+
+    def __init__(self, layer, featureRequest=None, chunkSize=BULK_CHUNK_SIZE, parent=None):
+        super(FeatureReader, self).__init__(parent)
+        # The feature source must be created on the main thread
+        self._source = QgsVectorLayerFeatureSource(layer)
+        if featureRequest is None:
+            self._request = QgsFeatureRequest()
+        else:
+            self._request = QgsFeatureRequest(featureRequest)
+        self._chunkSize = max(chunkSize, 1)
+        self._cancelled = False
+        # Read at most two chunks ahead of the caller
+        self._queue = Queue(2)
+        self._error = None
+
+    def cancel(self):
+        self._cancelled = True
+
+    # Wait for the next chunk, returns None once all the features have been read, or raises the exception if
+    # the read failed so a partial read isn't mistaken for all the features. No events are processed while
+    # waiting, as the caller may be part way through an edit with layer subsets cleared.
+    def nextChunk(self):
+        while True:
+            try:
+                chunk = self._queue.get(True, 0.05)
+            except Empty:
+                if self.isRunning() or not self._queue.empty():
+                    continue
+                chunk = None
+            if chunk is None and self._error is not None:
+                raise self._error
+            return chunk
+
+    def run(self):
+        fit = None
+        try:
+            fit = self._source.getFeatures(self._request)
+            for chunk in _chunks(fit, self._chunkSize):
+                if self._cancelled or not self._deliver(chunk):
+                    break
+        except Exception as error:
+            self._error = error
+        finally:
+            if fit is not None:
+                fit.close()
+            self._deliver(None)
+
+    def _deliver(self, chunk):
+        while not self._cancelled:
+            try:
+                self._queue.put(chunk, True, 0.05)
+                return True
+            except Full:
+                pass
+        return False
+
+# Iterate the features for a request with the reading done in a background thread, so reading the next chunk
+# overlaps whatever the caller does with the current one. Must be called from the main thread.
+def readFeatures(featureRequest, layer, chunkSize=BULK_CHUNK_SIZE):
+    reader = FeatureReader(layer, featureRequest, chunkSize)
+    reader.start()
+    try:
+        while True:
+            chunk = reader.nextChunk()
+            if chunk is None:
+                break
+            for feature in chunk:
+                yield feature
+    finally:
+        reader.cancel()
+        reader.wait()
+
+# Get at most count features for the request, closing the iterator afterwards
+def firstFeatures(featureRequest, layer, count):
     features = []
-    for feature in layer.getFeatures(featureRequest):
+    fit = layer.getFeatures(featureRequest)
+    for feature in fit:
         features.append(feature)
-    # Restore the previous subset
-    if subset:
-        layer.setSubsetString(subset)
-    # Restore the previous selection
-    if len(selection) > 0:
-        layer.select(selection)
+        if len(features) >= count:
+            break
+    fit.close()
     return features
 
-def addFeatures(features, layer, undoMessage='Add features to layer', log=False, logLayer=None, timestamp=None):
-    ok = False
-    if log and (not logLayer or not timestamp):
-        return ok
-    if not isWritable(layer) or (logLayer and not isWritable(logLayer)):
+# Number of features the request will return if known without running it, otherwise -1
+def requestCount(featureRequest, layer):
+    if featureRequest.filterType() == QgsFeatureRequest.FilterNone:
+        return layer.featureCount()
+    if featureRequest.filterType() == QgsFeatureRequest.FilterFid:
+        return 1
+    if featureRequest.filterType() == QgsFeatureRequest.FilterFids:
+        return len(featureRequest.filterFids())
+    return -1
+
+def reportProgress(progress, done, total):
+    return progress is None or progress(done, total) is not False
+
+# Map the source field indexes to the log layer field indexes once per operation, so each
+# logged feature can be built by position instead of looking every field up by name
+def _logFieldMap(fields, logLayer):
+    logFields = logLayer.fields()
+    fieldMap = []
+    for idx in range(fields.count()):
+        logIdx = logFields.indexFromName(fields.at(idx).name())
+        if logIdx >= 0:
+            fieldMap.append((idx, logIdx))
+    identity = all(idx == logIdx for idx, logIdx in fieldMap) and len(fieldMap) == fields.count()
+    return (logFields, fieldMap, identity, logFields.indexFromName('event'), logFields.indexFromName('timestamp'))
+
+def _logFeature(feature, logMap, event, timestamp):
+    logFields, fieldMap, identity, eventIdx, timestampIdx = logMap
+    attributes = [NULL] * logFields.count()
+    values = feature.attributes()
+    if identity:
+        count = min(len(values), len(fieldMap))
+        attributes[:count] = values[:count]
+    else:
+        for idx, logIdx in fieldMap:
+            if idx < len(values):
+                attributes[logIdx] = values[idx]
+    if eventIdx >= 0:
+        attributes[eventIdx] = event
+    if timestampIdx >= 0:
+        attributes[timestampIdx] = timestamp
+    logFeature = QgsFeature(logFields)
+    logFeature.setAttributes(attributes)
+    if feature.geometry():
+        logFeature.setGeometry(feature.geometry())
+    return logFeature
+
+def _addFeatureChunk(layer, chunk, logLayer=None, logChunk=None):
+    # Don't select the new features, it is expensive and changes the user selection
+    if logChunk and not logLayer.addFeatures(logChunk, False):
+        return False
+    return layer.addFeatures(chunk, False)
+
+def _deleteFeatureChunk(layer, chunk, logLayer, logMap, timestamp):
+    if logMap:
+        logChunk = [_logFeature(feature, logMap, 'delete', timestamp) for feature in chunk]
+        if not logLayer.addFeatures(logChunk, False):
+            return False
+    return layer.deleteFeatures([feature.id() for feature in chunk])
+
+# Group of layers whose edits are committed together, or all rolled back if any commit fails. Layers that
+# weren't being edited when the group began are left closed after a commit, the others are reopened for
+# editing. If the layers share a database connection that supports transactions then a provider transaction
+# is used, otherwise the layers are committed in order and if one fails the rest are rolled back and the
+# features already added by the earlier layers are deleted again. Deleted or changed features can't be
+# restored that way, so put the layer with deletes or changes last, e.g. [logLayer, layer, buffer].
+class LayerTransaction:
+
+    _layers = []  # [QgsVectorLayer]
+    _wasEditing = {}  # {layerId : undoIndex}
+    _transaction = None  # QgsTransaction
+
+    def __init__(self, layerList):
+        self._layers = [layer for layer in layerList if layer is not None]
+        self._wasEditing = {}
+        self._transaction = None
+
+    def layers(self):
+        return self._layers
+
+    def begin(self):
+        self._wasEditing = {}
+        for layer in self._layers:
+            if layer.isEditable():
+                self._wasEditing[layer.id()] = layer.undoStack().index()
+        if not self._wasEditing:
+            self._beginTransaction()
+        for layer in self._layers:
+            if not layer.isEditable() and not layer.startEditing():
+                self.rollBack()
+                return False
+        return True
+
+    def commit(self):
+        if self._transaction is not None:
+            return self._commitTransaction()
+        committed = []  # [(QgsVectorLayer, [featureId])]
+        for layer in self._layers:
+            added = []
+            def featuresAdded(layerId, features):
+                added.extend([feature.id() for feature in features])
+            layer.committedFeaturesAdded.connect(featuresAdded)
+            ok = layer.commitChanges()
+            layer.committedFeaturesAdded.disconnect(featuresAdded)
+            if not ok:
+                utils.logWarning('Commit failed on layer ' + layer.name() + ': ' + '; '.join(layer.commitErrors()))
+                self.rollBack()
+                self._deleteAdded(committed)
+                return False
+            committed.append((layer, added))
+            if layer.id() in self._wasEditing:
+                layer.startEditing()
+        return True
+
+    def rollBack(self):
+        for layer in self._layers:
+            if not layer.isEditable():
+                continue
+            if layer.id() in self._wasEditing:
+                # Only undo the changes made since the group began, the user's earlier edits are kept
+                layer.undoStack().setIndex(self._wasEditing[layer.id()])
+            else:
+                layer.rollBack()
+        if self._transaction is not None:
+            self._transaction.rollback()
+            self._transaction = None
+
+    def _beginTransaction(self):
+        self._transaction = None
+        if QgsTransaction is None or len(self._layers) < 2:
+            return
+        registry = QgsMapLayerRegistry.instance()
+        if any(registry.mapLayer(layer.id()) is None for layer in self._layers):
+            return
+        # Returns None if the layers aren't all on the same connection or the provider has no transactions
+        transaction = QgsTransaction.create([layer.id() for layer in self._layers])
+        if transaction is not None and transaction.begin()[0]:
+            self._transaction = transaction
+
+    def _commitTransaction(self):
+        ok = True
+        for layer in self._layers:
+            ok = ok and layer.commitChanges()
+        if ok:
+            ok, error = self._transaction.commit()
+            if not ok:
+                utils.logWarning('Transaction commit failed: ' + error)
+        if not ok:
+            self.rollBack()
+        self._transaction = None
+        if ok:
+            for layer in self._layers:
+                if layer.id() in self._wasEditing:
+                    layer.startEditing()
         return ok
-    # Stash the current subset
-    subset = layer.subsetString()
-    if subset:
-        layer.setSubsetString('')
-    # Copy the requested features
+
+    def _deleteAdded(self, committed):
+        for layer, featureIds in committed:
+            if not featureIds:
+                continue
+            ok = (layer.isEditable() or layer.startEditing()) and layer.deleteFeatures(featureIds) and layer.commitChanges()
+            if not ok:
+                utils.logWarning('Failed to remove committed features from layer ' + layer.name())
+                layer.rollBack()
+            if layer.id() in self._wasEditing and not layer.isEditable():
+                layer.startEditing()
+
+def _beginEdit(wasEditing, transaction, logLayer):
+    if wasEditing:
+        return logLayer is None or logLayer.isEditable() or logLayer.startEditing()
+    return transaction.begin()
+
+def _commitChunk(transaction):
+    return transaction.commit() and transaction.begin()
+
+def _endEdit(ok, wasEditing, layer, log, logLayer, transaction):
+    # If was already in edit mode, end or destroy the editing buffer
+    if wasEditing:
+        if ok:
+            if log:
+                logLayer.endEditCommand()
+            layer.endEditCommand()
+        else:
+            if log:
+                logLayer.destroyEditCommand()
+            layer.destroyEditCommand()
+    # If was already in edit mode, is up to caller to commit the log and layer, otherwise commit them together
+    elif ok:
+        ok = transaction.commit()
+    else:
+        transaction.rollBack()
+    return ok
+
+# Add features to the layer edit buffer in chunks, returns (ok, count)
+def _addFeatures(features, fields, layer, undoMessage, log, logLayer, timestamp, chunkSize, progress=None, total=-1, commitChunks=False):
+    ok = False
+    count = 0
+    committed = 0
+    if chunkSize is None or chunkSize < 1:
+        chunkSize = 1
     wasEditing = layer.isEditable()
-    if (wasEditing or layer.startEditing()) and (logLayer is None or logLayer.isEditable() or logLayer.startEditing()):
+    commitChunks = commitChunks and not wasEditing
+    # The log is committed first, so if the layer commit fails the log entries can be removed again
+    transaction = None
+    if not wasEditing:
+        transaction = LayerTransaction([logLayer if log else None, layer])
+    if _beginEdit(wasEditing, transaction, logLayer):
         if wasEditing:
             layer.beginEditCommand(undoMessage)
-        logFeature = None
         if log:
             if wasEditing:
                 logLayer.beginEditCommand(undoMessage)
-        ft = 0
-        for feature in features:
-            ft += 1
-            if log:
-                logFeature = QgsFeature(logLayer.fields())
-                if feature.geometry():
-                    logFeature.setGeometry(feature.geometry())
-                for field in layer.fields():
-                    logFeature.setAttribute(field.name(), feature.attribute(field.name()))
-                logFeature.setAttribute('event', 'insert')
-                logFeature.setAttribute('timestamp', timestamp)
-                ok = logLayer.addFeature(logFeature) and layer.addFeature(feature)
-            else:
-                ok = layer.addFeature(feature)
-        # If was already in edit mode, end or destroy the editing buffer
-        if wasEditing:
-            if ok:
-                if log:
-                    logLayer.endEditCommand()
-                layer.endEditCommand()
-            else:
-                if log:
-                    logLayer.destroyEditCommand()
-                layer.destroyEditCommand()
-        # If was already in edit mode, is up to caller to commit the log and layer
-        if not wasEditing:
-            if ok and log:
-                ok = logLayer.commitChanges()
-            if ok:
-                ok = layer.commitChanges()
-            if not ok:
+        ok = True
+        logMap = None
+        if log:
+            logMap = _logFieldMap(fields, logLayer)
+        try:
+            for chunk in _chunks(features, chunkSize):
+                logChunk = []
                 if log:
-                    try:
-                        logLayer.rollBack()
-                    except:
-                        utils.logMessage('TODO: Rollback on log layer???')
-                layer.rollBack()
-        if ft == 0:
-            ok = True
-    # Restore the previous subset
-    if subset:
-        layer.setSubsetString(subset)
-    return ok
+                    logChunk = [_logFeature(feature, logMap, 'insert', timestamp) for feature in chunk]
+                ok = _addFeatureChunk(layer, chunk, logLayer, logChunk)
+                if ok and commitChunks:
+                    ok = _commitChunk(transaction)
+                    if ok:
+                        committed = count + len(chunk)
+                if ok:
+                    count += len(chunk)
+                    ok = reportProgress(progress, count, total)
+                if not ok:
+                    break
+        except Exception as error:
+            # The features are read in the background, don't write a partial read as if it was all of them
+            utils.logWarning('Failed to read the features to add to layer ' + layer.name() + ': ' + str(error))
+            ok = False
+        ok = _endEdit(ok, wasEditing, layer, log, logLayer, transaction)
+        # Only the committed chunks got written if we had to destroy or roll back
+        if not ok:
+            count = committed
+    return ok, count
 
-def copyFeatureRequest(featureRequest, fromLayer, toLayer, undoMessage='Copy features', log=False, logLayer=None, timestamp=None):
+# Delete the requested features from the layer edit buffer in chunks, returns (ok, count). If the features
+# have already been fetched then pass them in instead of the request.
+def _deleteFeatures(featureRequest, layer, undoMessage, log, logLayer, timestamp, chunkSize, progress=None, commitChunks=False, features=None):
     ok = False
-    if log and (not logLayer or not timestamp):
-        return ok
-    if not isWritable(toLayer) or (logLayer and not isWritable(logLayer)):
-        return ok
-    # Stash the current subset
-    fromSubset = fromLayer.subsetString()
-    if fromSubset:
-        fromLayer.setSubsetString('')
-    toSubset = toLayer.subsetString()
-    if toSubset:
-        toLayer.setSubsetString('')
-    # Copy the requested features
-    wasEditing = toLayer.isEditable()
-    if (wasEditing or toLayer.startEditing()) and (logLayer is None or logLayer.isEditable() or logLayer.startEditing()):
+    count = 0
+    committed = 0
+    if chunkSize is None or chunkSize < 1:
+        chunkSize = 1
+    wasEditing = layer.isEditable()
+    # Feature ids may change on commit, so can't commit chunks if the request is by id
+    commitChunks = (commitChunks and not wasEditing and features is None
+                    and featureRequest.filterType() != QgsFeatureRequest.FilterFid
+                    and featureRequest.filterType() != QgsFeatureRequest.FilterFids)
+    # The log is committed first, so if the layer commit fails the log entries can be removed again
+    transaction = None
+    if not wasEditing:
+        transaction = LayerTransaction([logLayer if log else None, layer])
+    if _beginEdit(wasEditing, transaction, logLayer):
         if wasEditing:
-            toLayer.beginEditCommand(undoMessage)
-        logFeature = None
+            layer.beginEditCommand(undoMessage)
         if log:
             if wasEditing:
                 logLayer.beginEditCommand(undoMessage)
-        ft = 0
-        for feature in fromLayer.getFeatures(featureRequest):
-            ft += 1
-            if log:
-                logFeature = QgsFeature(logLayer.fields())
-                if feature.geometry():
-                    logFeature.setGeometry(feature.geometry())
-                for field in fromLayer.fields():
-                    logFeature.setAttribute(field.name(), feature.attribute(field.name()))
-                logFeature.setAttribute('event', 'insert')
-                logFeature.setAttribute('timestamp', timestamp)
-                ok = logLayer.addFeature(logFeature) and toLayer.addFeature(feature)
-            else:
-                ok = toLayer.addFeature(feature)
-            if not ok:
-                break
-        # If was already in edit mode, end or destroy the editing buffer
-        if wasEditing:
-            if ok:
-                if log:
-                    logLayer.endEditCommand()
-                toLayer.endEditCommand()
-            else:
-                if log:
-                    logLayer.destroyEditCommand()
-                toLayer.destroyEditCommand()
-        # If was already in edit mode, is up to caller to commit the log and layer
-        if not wasEditing:
-            if ok and log:
-                ok = logLayer.commitChanges()
-            if ok:
-                ok = toLayer.commitChanges()
-            if not ok:
-                if log:
-                    try:
-                        logLayer.rollBack()
-                    except:
-                        utils.logMessage('TODO: Rollback on log layer???')
-                toLayer.rollBack()
-        if ft == 0:
-            ok = True
-    # Restore the previous selection and subset
-    if fromSubset:
-        fromLayer.setSubsetString(fromSubset)
-    if toSubset:
-        toLayer.setSubsetString(toSubset)
-    return ok
+        ok = True
+        logMap = None
+        if log:
+            logMap = _logFieldMap(layer.fields(), logLayer)
+        if features is None:
+            total = requestCount(featureRequest, layer)
+            # Need the full features to log, otherwise only fetch the ids
+            request = featureRequest
+            if not log:
+                request = _idRequest(featureRequest, layer)
+        else:
+            total = len(features)
+        if commitChunks:
+            # Committing invalidates any open iterator, so re-run the request for each chunk
+            while ok:
+                chunk = firstFeatures(request, layer, chunkSize)
+                if len(chunk) == 0:
+                    break
+                ok = _deleteFeatureChunk(layer, chunk, logLayer, logMap, timestamp) and _commitChunk(transaction)
+                if ok:
+                    count += len(chunk)
+                    committed = count
+                    ok = reportProgress(progress, count, total)
+        else:
+            # Deleting from the edit buffer doesn't affect an already open iterator, so stream the deletes
+            if features is None:
+                features = layer.getFeatures(request)
+            for chunk in _chunks(features, chunkSize):
+                ok = _deleteFeatureChunk(layer, chunk, logLayer, logMap, timestamp)
+                if ok:
+                    count += len(chunk)
+                    ok = reportProgress(progress, count, total)
+                if not ok:
+                    break
+        ok = _endEdit(ok, wasEditing, layer, log, logLayer, transaction)
+        # Only the committed chunks got written if we had to destroy or roll back
+        if not ok:
+            count = committed
+    return ok, count
 
-def copyAllFeatures(fromLayer, toLayer, undoMessage='Copy features', log=False, logLayer=None, timestamp=None):
-    return copyFeatureRequest(QgsFeatureRequest(), fromLayer, toLayer, undoMessage, log, logLayer, timestamp)
+def addFeatures(features, layer, undoMessage='Add features to layer', log=False, logLayer=None, timestamp=None, chunkSize=BULK_CHUNK_SIZE, progress=None, commitChunks=False):
+    return bulkAddFeatures(features, layer, undoMessage, log, logLayer, timestamp, chunkSize, progress, commitChunks)[0]
 
-def deleteFeatureRequest(featureRequest, layer, undoMessage='Delete features', log=False, logLayer=None, timestamp=None):
-    ok = False
+# As addFeatures() but returns (ok, count) with the number of features added
+def bulkAddFeatures(features, layer, undoMessage='Add features to layer', log=False, logLayer=None, timestamp=None, chunkSize=BULK_CHUNK_SIZE, progress=None, commitChunks=False):
     if log and (not logLayer or not timestamp):
-        return ok
+        return False, 0
     if not isWritable(layer) or (logLayer and not isWritable(logLayer)):
-        return ok
-    # Stash the current subset
-    subset = layer.subsetString()
-    if subset:
-        layer.setSubsetString('')
+        return False, 0
+    target, subset, selection = clearSubset(layer)
+    # Copy the requested features
+    total = -1
+    if isinstance(features, list):
+        total = len(features)
+    ok, count = _addFeatures(features, layer.fields(), target, undoMessage, log, logLayer, timestamp, chunkSize, progress, total, commitChunks)
+    restoreSubset(layer, target, subset, selection, count > 0)
+    return ok, count
+
+def copyFeatureRequest(featureRequest, fromLayer, toLayer, undoMessage='Copy features', log=False, logLayer=None, timestamp=None, chunkSize=BULK_CHUNK_SIZE, progress=None, commitChunks=False):
+    return bulkCopyFeatureRequest(featureRequest, fromLayer, toLayer, undoMessage, log, logLayer, timestamp, chunkSize, progress, commitChunks)[0]
+
+# As copyFeatureRequest() but returns (ok, count) with the number of features copied
+def bulkCopyFeatureRequest(featureRequest, fromLayer, toLayer, undoMessage='Copy features', log=False, logLayer=None, timestamp=None, chunkSize=BULK_CHUNK_SIZE, progress=None, commitChunks=False):
+    if log and (not logLayer or not timestamp):
+        return False, 0
+    if not isWritable(toLayer) or (logLayer and not isWritable(logLayer)):
+        return False, 0
+    source, fromSubset, fromSelection = clearSubset(fromLayer)
+    target, toSubset, toSelection = clearSubset(toLayer)
     # Copy the requested features
+    total = requestCount(featureRequest, source)
+    # Read in the background while the previous chunk is written to the edit buffer
+    ok, count = _addFeatures(readFeatures(featureRequest, source, chunkSize), source.fields(), target, undoMessage, log, logLayer, timestamp, chunkSize, progress, total, commitChunks)
+    restoreSubset(fromLayer, source, fromSubset, fromSelection)
+    restoreSubset(toLayer, target, toSubset, toSelection, count > 0)
+    return ok, count
+
+def copyAllFeatures(fromLayer, toLayer, undoMessage='Copy features', log=False, logLayer=None, timestamp=None, chunkSize=BULK_CHUNK_SIZE, progress=None, commitChunks=False):
+    return copyFeatureRequest(QgsFeatureRequest(), fromLayer, toLayer, undoMessage, log, logLayer, timestamp, chunkSize, progress, commitChunks)
+
+# Copy a request to only fetch the feature ids, plus whatever the filter expression needs
+def _idRequest(featureRequest, layer):
+    return hintRequest(featureRequest, layer, [], True)
+
+def deleteFeatureRequest(featureRequest, layer, undoMessage='Delete features', log=False, logLayer=None, timestamp=None, chunkSize=BULK_CHUNK_SIZE, progress=None, commitChunks=False):
+    return bulkDeleteFeatureRequest(featureRequest, layer, undoMessage, log, logLayer, timestamp, chunkSize, progress, commitChunks)[0]
+
+# As deleteFeatureRequest() but returns (ok, count) with the number of features deleted
+def bulkDeleteFeatureRequest(featureRequest, layer, undoMessage='Delete features', log=False, logLayer=None, timestamp=None, chunkSize=BULK_CHUNK_SIZE, progress=None, commitChunks=False):
+    if log and (not logLayer or not timestamp):
+        return False, 0
+    if not isWritable(layer) or (logLayer and not isWritable(logLayer)):
+        return False, 0
+    target, subset, selection = clearSubset(layer)
+    # Delete the requested features
+    ok, count = _deleteFeatures(featureRequest, target, undoMessage, log, logLayer, timestamp, chunkSize, progress, commitChunks)
+    restoreSubset(layer, target, subset, selection, count > 0)
+    return ok, count
+
+def deleteAllFeatures(layer, undoMessage='Delete features', log=False, logLayer=None, timestamp=None, chunkSize=BULK_CHUNK_SIZE, progress=None, commitChunks=False):
+    return deleteFeatureRequest(QgsFeatureRequest(), layer, undoMessage, log, logLayer, timestamp, chunkSize, progress, commitChunks)
+
+def replaceFeatures(replacements, layer, undoMessage='Replace features', log=False, logLayer=None, timestamp=None):
+    return bulkReplaceFeatures(replacements, layer, undoMessage, log, logLayer, timestamp)[0]
+
+# Replace the geometry and attributes of existing features in place, replacements is {featureId : feature}
+# with the new features having the same fields as the layer. Returns (ok, count) with the number of
+# features replaced, the new values are logged as an 'update' event if required.
+def bulkReplaceFeatures(replacements, layer, undoMessage='Replace features', log=False, logLayer=None, timestamp=None):
+    if log and (not logLayer or not timestamp):
+        return False, 0
+    if not isWritable(layer) or (logLayer and not isWritable(logLayer)):
+        return False, 0
+    if len(replacements) == 0:
+        return True, 0
+    ok = False
+    count = 0
     wasEditing = layer.isEditable()
-    if (wasEditing or layer.startEditing()) and (logLayer is None or logLayer.isEditable() or logLayer.startEditing()):
+    transaction = None
+    if not wasEditing:
+        transaction = LayerTransaction([logLayer if log else None, layer])
+    if _beginEdit(wasEditing, transaction, logLayer):
         if wasEditing:
             layer.beginEditCommand(undoMessage)
-        logFeature = None
-        if log:
-            if wasEditing:
-                logLayer.beginEditCommand(undoMessage)
-        ft = 0
-        for feature in layer.getFeatures(featureRequest):
-            ft += 1
             if log:
-                logFeature = QgsFeature(logLayer.fields())
-                if feature.geometry():
-                    logFeature.setGeometry(feature.geometry())
-                for field in layer.fields():
-                    logFeature.setAttribute(field.name(), feature.attribute(field.name()))
-                logFeature.setAttribute('event', 'delete')
-                logFeature.setAttribute('timestamp', timestamp)
-                ok = logLayer.addFeature(logFeature) and layer.deleteFeature(feature.id())
-            else:
-                ok = layer.deleteFeature(feature.id())
+                logLayer.beginEditCommand(undoMessage)
+        ok = True
+        # Don't overwrite the provider keys, the new features will have their own
+        keys = set(layer.dataProvider().pkAttributeIndexes())
+        attributes = [idx for idx in range(layer.fields().count()) if idx not in keys]
+        logChunk = []
+        if log:
+            logMap = _logFieldMap(layer.fields(), logLayer)
+        for featureId, feature in replacements.items():
+            ok = _replaceFeature(layer, featureId, feature, attributes)
             if not ok:
                 break
-        # If was already in edit mode, end or destroy the editing buffer
-        if wasEditing:
-            if ok:
-                if log:
-                    logLayer.endEditCommand()
-                layer.endEditCommand()
-            else:
-                if log:
-                    logLayer.destroyEditCommand()
-                layer.destroyEditCommand()
-        # If was already in edit mode, is up to caller to commit the log and layer
-        if not wasEditing:
-            if ok and log:
-                ok = logLayer.commitChanges()
-            if ok:
-                ok = layer.commitChanges()
-            if not ok:
-                if log:
-                    try:
-                        logLayer.rollBack()
-                    except:
-                        utils.logMessage('TODO: Rollback on log layer???')
-                layer.rollBack()
-        if ft == 0:
-            ok = True
-    # Restore the previous subset
-    if subset:
-        layer.setSubsetString(subset)
-    return ok
+            if log:
+                logChunk.append(_logFeature(feature, logMap, 'update', timestamp))
+            count += 1
+        if ok and log:
+            ok = logLayer.addFeatures(logChunk, False)
+        ok = _endEdit(ok, wasEditing, layer, log, logLayer, transaction)
+        if not ok:
+            count = 0
+    return ok, count
+
+def _replaceFeature(layer, featureId, feature, attributes):
+    if feature.geometry() and not layer.changeGeometry(featureId, feature.geometry()):
+        return False
+    values = feature.attributes()
+    for idx in attributes:
+        if idx < len(values) and not layer.changeAttributeValue(featureId, idx, values[idx]):
+            return False
+    return True
 
-def deleteAllFeatures(layer, undoMessage='Delete features', log=False, logLayer=None, timestamp=None):
-    return deleteFeatureRequest(QgsFeatureRequest(), layer, undoMessage, log, logLayer, timestamp)
+def moveFeatureRequest(featureRequest, fromLayer, toLayer, undoMessage='Move features', log=False, logLayer=None, timestamp=None, chunkSize=BULK_CHUNK_SIZE):
+    return bulkMoveFeatureRequest(featureRequest, fromLayer, toLayer, undoMessage, log, logLayer, timestamp, chunkSize)[0]
+
+# Move the requested features to another layer, returns (ok, count) with the number of features moved. The
+# request is only evaluated once, the matched features are copied and then deleted by id. Any of the layers
+# not already being edited are committed together, the deletes are logged if required.
+def bulkMoveFeatureRequest(featureRequest, fromLayer, toLayer, undoMessage='Move features', log=False, logLayer=None, timestamp=None, chunkSize=BULK_CHUNK_SIZE):
+    if log and (not logLayer or not timestamp):
+        return False, 0
+    if not isWritable(fromLayer) or not isWritable(toLayer) or (logLayer and not isWritable(logLayer)):
+        return False, 0
+    source, fromSubset, fromSelection = clearSubset(fromLayer)
+    target, toSubset, toSelection = clearSubset(toLayer)
+    ok = True
+    count = 0
+    try:
+        features = list(readFeatures(featureRequest, source, chunkSize))
+    except Exception as error:
+        utils.logWarning('Failed to read the features to move from layer ' + fromLayer.name() + ': ' + str(error))
+        ok = False
+        features = []
+    if len(features) > 0:
+        # The deletes are committed last so a failure can't lose the features
+        groupLayers = [layer for layer in (target, logLayer if log else None, source) if layer is not None and not layer.isEditable()]
+        transaction = LayerTransaction(groupLayers)
+        ok = transaction.begin()
+        if ok:
+            ok, count = _addFeatures(features, source.fields(), target, undoMessage, False, None, None, chunkSize)
+            ok = (ok and _deleteFeatures(None, source, undoMessage, log, logLayer, timestamp, chunkSize, features=features)[0]
+                  and transaction.commit())
+            if not ok:
+                transaction.rollBack()
+                count = 0
+    restoreSubset(fromLayer, source, fromSubset, fromSelection, count > 0)
+    restoreSubset(toLayer, target, toSubset, toSelection, count > 0)
+    return ok, count
 
 def childGroupIndex(parentGroupName, childGroupName):
     root = QgsProject.instance().layerTreeRoot()
@@ -554,44 +1331,417 @@ def collapseChildren(groupName):
         child.setExpanded(False)
 
 def applyFilter(iface, layer, expression):
-    if (layer is None or not layer.isValid() or layer.type() != QgsMapLayer.VectorLayer):
+    applyFilters(iface, [layer], expression)
+
+# Apply the filter to all the layers with a single canvas refresh at the end, layers whose filter hasn't
+# changed are skipped so their providers aren't reloaded. Extents are only recalculated when next needed.
+def applyFilters(iface, layerList, expression):
+    layerList = [layer for layer in layerList if isValid(layer) and layer.subsetString() != expression]
+    if len(layerList) == 0:
         return
-    iface.mapCanvas().stopRendering()
-    layer.setSubsetString(expression)
-    layer.updateExtents()
-    iface.legendInterface().refreshLayerSymbology(layer)
+    canvas = iface.mapCanvas()
+    canvas.stopRendering()
+    frozen = canvas.isFrozen()
+    canvas.freeze(True)
+    for layer in layerList:
+        layer.setSubsetString(expression)
+        layer.updateExtents()
+    canvas.freeze(frozen)
+    for layer in layerList:
+        iface.legendInterface().refreshLayerSymbology(layer)
+    if not frozen:
+        canvas.refresh()
 
 def applyFilterRequest(layer, request):
     applyFilter(request.filterExpression().dump())
 
-def applySelection(layer, expression):
+def applySelection(layer, expression, rect=None):
     request = QgsFeatureRequest().setFilterExpression(expression)
-    applySelectionRequest(layer, request)
+    applySelectionRequest(layer, request, rect)
 
-def applySelectionRequest(layer, request):
+def applySelectionRequest(layer, request, rect=None):
     if (layer is None or not layer.isValid() or layer.type() != QgsMapLayer.VectorLayer):
         return
-    fit = layer.getFeatures(request)
-    layer.setSelectedFeatures([f.id() for f in fit])
+    layer.setSelectedFeatures(getFeatureIdsRequest(request, layer, rect))
+
+# Cached results of expression queries, cleared whenever the layer is edited
+_featureIdCache = {}  # {layerId : {(expression, subset, rect) : [featureId]}}
+
+def _featureIdCacheFor(layer):
+    layerId = layer.id()
+    cache = _featureIdCache.get(layerId)
+    if cache is None:
+        _connectRegistry()
+        cache = {}
+        _featureIdCache[layerId] = cache
+        layer.layerModified.connect(cache.clear)
+        layer.editingStopped.connect(cache.clear)
+    return cache
+
+# Get the ids of the features matching the request without fetching any more than the filter needs, optionally
+# only within the rect. The results of expression requests are cached until the layer is next edited.
+def getFeatureIdsRequest(featureRequest, layer, rect=None):
+    if rect is not None and rect.isEmpty():
+        rect = None
+    if featureRequest.filterType() == QgsFeatureRequest.FilterNone and rect is not None:
+        featureRequest = QgsFeatureRequest(featureRequest).setFilterRect(rect)
+    if rect is not None and featureRequest.filterType() in (QgsFeatureRequest.FilterFid, QgsFeatureRequest.FilterFids):
+        return [feature.id() for feature in getFeaturesInRect(featureRequest, layer, rect)]
+    if featureRequest.filterType() != QgsFeatureRequest.FilterExpression or featureRequest.filterExpression() is None:
+        return [feature.id() for feature in layer.getFeatures(_idRequest(featureRequest, layer))]
+    expression = featureRequest.filterExpression().expression()
+    key = (expression, layer.subsetString(), rect.toString() if rect is not None else '')
+    cache = _featureIdCacheFor(layer)
+    if key not in cache:
+        if rect is None:
+            cache[key] = [feature.id() for feature in layer.getFeatures(_idRequest(featureRequest, layer))]
+        else:
+            # Only fetch the expression attributes and the geometry to test against the rect
+            request = hintRequest(featureRequest, layer, [], False)
+            cache[key] = [feature.id() for feature in getFeaturesInRect(request, layer, rect)]
+    return list(cache[key])
+
+# Iterate the features matching the request that are within the rect. A request can't have both a rect and
+# another filter, so a filtered request is run as it is and the bounding boxes are tested against the rect here,
+# rather than evaluating the expression in Python for every feature in the rect.
+def getFeaturesInRect(featureRequest, layer, rect):
+    filterType = featureRequest.filterType()
+    if filterType == QgsFeatureRequest.FilterNone or (filterType == QgsFeatureRequest.FilterExpression
+                                                      and featureRequest.filterExpression() is None):
+        for feature in layer.getFeatures(QgsFeatureRequest(featureRequest).setFilterRect(rect)):
+            yield feature
+    else:
+        if filterType == QgsFeatureRequest.FilterRect:
+            rect = rect.intersect(featureRequest.filterRect())
+        for feature in layer.getFeatures(featureRequest):
+            if feature.geometry() and feature.geometry().boundingBox().intersects(rect):
+                yield feature
+
+# Index of the values of a field in a layer, built on first use and then kept up to date from the layer edit and
+# commit signals, including commits through the unfiltered copy. Only rebuilt if the fields change.
+class UniqueValuesIndex:
+
+    _layer = None  # QgsVectorLayer()
+    _fieldName = ''
+    _fieldIndex = -1
+    _unfiltered = False  # Index the features outside the subset as well
+    _subset = ''
+    _stale = True
+    _values = {}  # {featureId : value}
+    _counts = {}  # {value : count}
+    _features = {}  # {value : set(featureId)}
+    _pending = set()  # Added featureIds not yet read
+    _sorted = None  # [value]
+
+    def __init__(self, layer, fieldName, unfiltered=False):
+        self._layer = layer
+        self._fieldName = fieldName
+        self._unfiltered = unfiltered
+        self._values = {}
+        self._counts = {}
+        self._features = {}
+        self._pending = set()
+        layer.featureAdded.connect(self._featureAdded)
+        layer.featureDeleted.connect(self._featureDeleted)
+        layer.attributeValueChanged.connect(self._attributeValueChanged)
+        connectCommitted(layer, 'committedFeaturesAdded', self._committedFeaturesAdded)
+        connectCommitted(layer, 'committedFeaturesRemoved', self._committedFeaturesRemoved)
+        connectCommitted(layer, 'committedAttributeValuesChanges', self._committedAttributeValuesChanges)
+        # The field indexes change with the fields, so start again
+        layer.updatedFields.connect(self.invalidate)
+
+    def invalidate(self):
+        self._stale = True
+
+    # Sorted list of the unique values, excluding NULL
+    def values(self):
+        self._update()
+        if self._sorted is None:
+            self._sorted = sorted([value for value in self._counts if value is not None])
+        return self._sorted
+
+    # Dict of the count of each value, NULL is counted as None
+    def counts(self):
+        self._update()
+        return dict(self._counts)
+
+    # The subset the index was built with, an unfiltered index only has one if there is no unfiltered copy
+    def subset(self):
+        self._update()
+        return self._subset
+
+    # List of the ids of the features with the value, NULL is looked up as None
+    def featureIds(self, value):
+        if value == NULL:
+            value = None
+        self._update()
+        return list(self._features.get(value, ()))
+
+    def _featureAdded(self, featureId):
+        self._pending.add(featureId)
+
+    def _featureDeleted(self, featureId):
+        if featureId in self._pending:
+            self._pending.discard(featureId)
+        elif not self._stale and featureId in self._values:
+            self._removeValue(featureId, self._values.pop(featureId))
+
+    def _attributeValueChanged(self, featureId, fieldIndex, value):
+        if self._stale or fieldIndex != self._fieldIndex or featureId in self._pending or featureId not in self._values:
+            return
+        self._removeValue(featureId, self._values[featureId])
+        self._setValue(featureId, value)
+
+    # The added features have their permanent ids once committed
+    def _committedFeaturesAdded(self, layerId, features):
+        if self._stale:
+            return
+        for featureId in [featureId for featureId in self._values if featureId < 0]:
+            self._removeValue(featureId, self._values.pop(featureId))
+        self._pending = set([featureId for featureId in self._pending if featureId >= 0])
+        fieldIndex = self._providerFieldIndex()
+        if fieldIndex < 0:
+            self.invalidate()
+            return
+        for feature in features:
+            self._commitValue(feature.id(), feature.attributes()[fieldIndex])
+
+    def _committedFeaturesRemoved(self, layerId, featureIds):
+        if self._stale:
+            return
+        for featureId in featureIds:
+            self._pending.discard(featureId)
+            if featureId in self._values:
+                self._removeValue(featureId, self._values.pop(featureId))
+        if self._layer.storageType() != 'ESRI Shapefile':
+            return
+        # Shapefiles are repacked after a delete, which renumbers the remaining features in order
+        removed = sorted(featureIds)
+        def renumber(featureId):
+            if featureId < 0:
+                return featureId
+            return featureId - bisect.bisect_left(removed, featureId)
+        self._values = dict([(renumber(featureId), value) for featureId, value in self._values.items()])
+        self._pending = set([renumber(featureId) for featureId in self._pending])
+        self._features = {}
+        for featureId, value in self._values.items():
+            self._features.setdefault(value, set()).add(featureId)
+
+    def _committedAttributeValuesChanges(self, layerId, changes):
+        fieldIndex = self._providerFieldIndex()
+        if self._stale or fieldIndex < 0:
+            return
+        for featureId, attributes in changes.items():
+            if fieldIndex in attributes:
+                self._commitValue(featureId, attributes[fieldIndex])
+
+    # Committed features only have the provider fields
+    def _providerFieldIndex(self):
+        return self._layer.dataProvider().fieldNameIndex(self._fieldName)
+
+    def _commitValue(self, featureId, value):
+        if featureId in self._values:
+            self._removeValue(featureId, self._values.pop(featureId))
+        if self._subset:
+            # Can't tell if the feature is in the subset, so read it through the layer
+            self._pending.add(featureId)
+        else:
+            self._setValue(featureId, value)
+
+    def _setValue(self, featureId, value):
+        if value is None or value == NULL:
+            value = None
+        self._values[featureId] = value
+        self._counts[value] = self._counts.get(value, 0) + 1
+        self._features.setdefault(value, set()).add(featureId)
+        self._sorted = None
+
+    def _removeValue(self, featureId, value):
+        count = self._counts.get(value, 0) - 1
+        if count > 0:
+            self._counts[value] = count
+            self._features[value].discard(featureId)
+        else:
+            self._counts.pop(value, None)
+            self._features.pop(value, None)
+        self._sorted = None
+
+    def _update(self):
+        subset = self._layer.subsetString()
+        if self._stale or (self._subset != subset and not (self._unfiltered and not self._subset)):
+            self._fieldIndex = self._layer.fieldNameIndex(self._fieldName)
+            self._values = {}
+            self._counts = {}
+            self._features = {}
+            self._pending = set()
+            self._sorted = None
+            self._stale = False
+            source = self._layer
+            if self._unfiltered and subset:
+                source = unfilteredLayer(self._layer) or self._layer
+            self._subset = source.subsetString()
+            if self._fieldIndex >= 0:
+                # A full scan can be slow, so read it in the background
+                self._readValues(source, QgsFeatureRequest(), True)
+                if source is not self._layer:
+                    self._readEditBuffer()
+        if len(self._pending) > 0:
+            request = QgsFeatureRequest().setFilterFids(list(self._pending))
+            self._pending = set()
+            if self._fieldIndex >= 0:
+                self._readValues(self._layer, request)
+
+    def _readValues(self, source, request, background=False):
+        fieldIndex = source.fieldNameIndex(self._fieldName)
+        if fieldIndex < 0:
+            return
+        request = hintRequest(request, source, [self._fieldName], True)
+        features = readFeatures(request, source) if background else source.getFeatures(request)
+        try:
+            for feature in features:
+                self._setValue(feature.id(), feature.attributes()[fieldIndex])
+        except Exception:
+            # Don't keep a partial index
+            self.invalidate()
+            raise
+
+    # The unfiltered copy only has the committed features, so apply any uncommitted edits to the layer
+    def _readEditBuffer(self):
+        editBuffer = self._layer.editBuffer()
+        if not self._layer.isEditable() or editBuffer is None:
+            return
+        for featureId in editBuffer.deletedFeatureIds():
+            if featureId in self._values:
+                self._removeValue(featureId, self._values.pop(featureId))
+        for featureId, attributes in editBuffer.changedAttributeValues().items():
+            if self._fieldIndex in attributes and featureId in self._values:
+                self._removeValue(featureId, self._values[featureId])
+                self._setValue(featureId, attributes[self._fieldIndex])
+        self._pending.update(editBuffer.addedFeatures().keys())
+
+
+_valueIndexes = {}  # {(layerId, fieldName, unfiltered) : UniqueValuesIndex}
+
+def uniqueValuesIndex(layer, fieldName, unfiltered=False):
+    key = (layer.id(), fieldName, unfiltered)
+    index = _valueIndexes.get(key)
+    if index is None:
+        _connectRegistry()
+        index = UniqueValuesIndex(layer, fieldName, unfiltered)
+        _valueIndexes[key] = index
+    return index
 
 def uniqueValues(layer, fieldName):
     res = set()
     if layer and layer.isValid():
-        values = layer.uniqueValues(layer.fieldNameIndex(fieldName))
-        for val in values:
-            if val != NULL:
-                res.add(val)
+        res.update(uniqueValuesIndex(layer, fieldName).values())
     return res
 
+def uniqueValueCounts(layer, fieldName):
+    if layer and layer.isValid():
+        counts = uniqueValuesIndex(layer, fieldName).counts()
+        counts.pop(None, None)
+        return counts
+    return {}
+
+# Simple key field expressions, e.g. "context" = '123' or "context" IN ('123', '124'), that can be looked up
+# in the field value index instead of being evaluated on every feature
+_literalPattern = r"(?:'(?:[^']|'')*'|-?\d+(?:\.\d+)?)"
+_eqExpression = re.compile(r'^\s*"((?:[^"]|"")+)"\s*=\s*(' + _literalPattern + r')\s*$')
+_inExpression = re.compile(r'^\s*"((?:[^"]|"")+)"\s+[Ii][Nn]\s*\(((?:\s*' + _literalPattern + r'\s*,)*\s*' + _literalPattern + r')\s*\)\s*$')
+_literal = re.compile(_literalPattern)
+
+# Returns (fieldName, [literal]) for a simple key field expression, otherwise None
+def _keyExpression(expression):
+    match = _eqExpression.match(expression)
+    if match is None:
+        match = _inExpression.match(expression)
+    if match is None:
+        return None
+    return match.group(1).replace('""', '"'), _literal.findall(match.group(2))
+
+# Convert the literals to the field type the same way the expression would compare them, returns None if
+# any can't be converted or the field type isn't supported
+def _keyValues(field, literals):
+    values = []
+    for literal in literals:
+        quoted = literal.startswith("'")
+        if quoted:
+            literal = literal[1:-1].replace("''", "'")
+        try:
+            if field.type() == QVariant.String and quoted:
+                values.append(literal)
+            elif field.type() in (QVariant.Int, QVariant.UInt, QVariant.LongLong, QVariant.ULongLong):
+                values.append(int(literal))
+            elif field.type() == QVariant.Double:
+                values.append(float(literal))
+            else:
+                return None
+        except ValueError:
+            return None
+    return values
+
+# If the request filter is a simple expression on one of the key fields then get a request for the matching
+# feature ids from the field value index instead. The index is built from the unfiltered layer so it isn't
+# rebuilt when the subset changes, a feature id request on the layer is still limited by the subset. If the
+# layer has no unfiltered copy the index follows the subset, so isn't used if the request ignores the subset.
+def indexedRequest(featureRequest, layer, keyFields, ignoreSubset=False):
+    if (layer is None or not keyFields or featureRequest.filterType() != QgsFeatureRequest.FilterExpression
+            or featureRequest.filterExpression() is None):
+        return featureRequest
+    key = _keyExpression(featureRequest.filterExpression().expression())
+    if key is None or key[0] not in keyFields:
+        return featureRequest
+    fieldName, literals = key
+    fieldIndex = layer.fieldNameIndex(fieldName)
+    if fieldIndex < 0:
+        return featureRequest
+    values = _keyValues(layer.fields().at(fieldIndex), literals)
+    if values is None:
+        return featureRequest
+    index = uniqueValuesIndex(layer, fieldName, True)
+    if ignoreSubset and index.subset():
+        return featureRequest
+    featureIds = set()
+    for value in values:
+        featureIds.update(index.featureIds(value))
+    return QgsFeatureRequest(featureRequest).setFilterFids(list(featureIds))
+
 def updateAttribute(layer, attribute, value, expression=None):
-    idx = layer.fieldNameIndex(attribute)
-    fit = None
-    if expression is None or expression == '':
-        fit = layer.getFeatures()
+    return updateAttributes(layer, {attribute : value}, expression)
+
+# Change several attributes at once on all the features matching the expression using a single id only pass.
+# The layer must be being edited, the changes are made in a single undo command.
+def updateAttributes(layer, attributeValues, expression=None, undoMessage='Update attributes'):
+    if isInvalid(layer) or not layer.isEditable():
+        return False
+    values = _fieldValues(layer.fields(), attributeValues)
+    if len(values) == 0:
+        return False
+    request = QgsFeatureRequest()
+    if expression:
+        request.setFilterExpression(expression)
+    featureIds = [feature.id() for feature in layer.getFeatures(_idRequest(request, layer))]
+    if len(featureIds) == 0:
+        return True
+    ok = True
+    layer.beginEditCommand(undoMessage)
+    for featureId in featureIds:
+        for idx, value in values.items():
+            ok = layer.changeAttributeValue(featureId, idx, value) and ok
+    if ok:
+        layer.endEditCommand()
     else:
-        fit = layer.getFeatures(QgsFeatureRequest().setFilterExpression(expression))
-    for f in fit:
-        layer.changeAttributeValue(f.id(), idx, value)
+        layer.destroyEditCommand()
+    return ok
+
+def _fieldValues(fields, attributeValues):
+    values = {}
+    for attribute, value in attributeValues.items():
+        idx = fields.indexFromName(attribute)
+        if idx >= 0:
+            values[idx] = value
+    return values
 
 def isValid(layer):
     return (layer is not None and layer.isValid() and layer.type() == QgsMapLayer.VectorLayer)
@@ -599,18 +1749,79 @@ def isValid(layer):
 def isInvalid(layer):
     return not isValid(layer)
 
+# Cached layer extents, so getting the extent doesn't force a full recalculation on OGR sources every time.
+# Cleared when the layer geometry changes, and recalculated if the subset has changed.
+_extentCache = {}  # {layerId : (subset, QgsRectangle)}
+_extentConnected = set()
+
+def _clearExtent(layerId):
+    _extentCache.pop(layerId, None)
+
+def layerExtent(layer):
+    layerId = layer.id()
+    if layerId not in _extentConnected:
+        _connectRegistry()
+        _extentConnected.add(layerId)
+        layer.geometryChanged.connect(lambda featureId, geometry: _clearExtent(layerId))
+        layer.featureAdded.connect(lambda featureId: _clearExtent(layerId))
+        layer.featureDeleted.connect(lambda featureId: _clearExtent(layerId))
+        layer.editingStopped.connect(lambda: _clearExtent(layerId))
+    cached = _extentCache.get(layerId)
+    if cached is None or cached[0] != layer.subsetString():
+        layer.updateExtents()
+        cached = (layer.subsetString(), QgsRectangle(layer.extent()))
+        _extentCache[layerId] = cached
+    return QgsRectangle(cached[1])
+
+# Cache of shapefile writability, checking needs several file stats which are slow on network drives. Entries
+# are dropped when any watched file changes, and in case the watcher misses changes on a network drive they
+# also expire after WRITABLE_CACHE_SECONDS.
+
+WRITABLE_CACHE_SECONDS = 30
+_writableCache = {}  # {(layerId, source) : (writable, checkedTime)}
+_writableWatcher = None  # QFileSystemWatcher()
+_watchedFiles = set()
+
+def _writableFileChanged(path):
+    # The watcher stops watching a file once it is removed
+    if not QFile.exists(path):
+        _watchedFiles.discard(path)
+    _writableCache.clear()
+
+def _watchFiles(paths):
+    global _writableWatcher
+    if _writableWatcher is None:
+        _writableWatcher = QFileSystemWatcher()
+        _writableWatcher.fileChanged.connect(_writableFileChanged)
+    paths = [path for path in paths if path not in _watchedFiles]
+    if len(paths) > 0:
+        _writableWatcher.addPaths(paths)
+        _watchedFiles.update(paths)
+
+def _clearWritableCache(layerId):
+    for key in [key for key in _writableCache if key[0] == layerId]:
+        del _writableCache[key]
+
 def isWritable(layer):
     if isInvalid(layer) or len(layer.vectorJoins()) > 0:
         return False
     if layer.storageType() == 'ESRI Shapefile':
+        _connectRegistry()
+        key = (layer.id(), layer.source())
+        cached = _writableCache.get(key)
+        if cached is not None and time.time() - cached[1] < WRITABLE_CACHE_SECONDS:
+            return cached[0]
         sourceList = layer.source().split('|')
         shpFile = QFileInfo(sourceList[0])
         baseFilePath = shpFile.canonicalPath() + '/' + shpFile.completeBaseName()
         shxFile = QFileInfo(baseFilePath + '.shx')
         dbfFile = QFileInfo(baseFilePath + '.dbf')
-        return (shpFile.exists() and shpFile.isWritable()
-                and shxFile.exists() and shxFile.isWritable()
-                and dbfFile.exists() and dbfFile.isWritable())
+        writable = (shpFile.exists() and shpFile.isWritable()
+                    and shxFile.exists() and shxFile.isWritable()
+                    and dbfFile.exists() and dbfFile.isWritable())
+        _writableCache[key] = (writable, time.time())
+        _watchFiles([fileInfo.absoluteFilePath() for fileInfo in (shpFile, shxFile, dbfFile) if fileInfo.exists()])
+        return writable
     return True
 
 def addHighlight(canvas, featureOrGeometry, layer, lineColor=None, fillColor=None, buff=None, minWidth=None):